@@ -506,6 +506,45 @@ def get_s20_diagnostic(rootdir):
     return diagnostics_dict
 
 
+def get_s20_multi_index_diagnostic(rootdir):
+    # The s20 diagnostics grouped by input variable and its spec
+    # (preprocessor, mip, ...), so that diag_indices.py loads each
+    # preprocessed file only once; all of them share one cache of area
+    # weights for the common grid
+    diagnostics = get_s20_diagnostic(rootdir)["diagnostics"]
+    groups = {}
+    for index, diagnostic in diagnostics.items():
+        for variable, spec in diagnostic["variables"].items():
+            key = (variable, tuple(sorted(spec.items())))
+            groups.setdefault(key, (dict(spec), []))[1].append(index)
+    n_specs = {}
+    for variable, _ in groups:
+        n_specs[variable] = n_specs.get(variable, 0) + 1
+    diagnostics_dict = {"diagnostics": {}}
+    for (variable, _), (spec, variable_indices) in groups.items():
+        name = variable + "_indices"
+        if n_specs[variable] > 1:
+            # Indices of the same variable with different specs
+            # are computed by diagnostics of their own
+            suffix = [spec[k] for k in ["preprocessor", "mip"] if k in spec]
+            name = "_".join([variable] + suffix + ["indices"])
+        diagnostics_dict["diagnostics"][name] = {
+            "title": variable + " indices",
+            "description": "Diagnostic to compute the "
+            + ", ".join(variable_indices)
+            + " indices",
+            "variables": {variable: spec},
+            "scripts": {
+                name: {
+                    "script": os.path.join(rootdir, "diag_scripts/diag_indices.py"),
+                    "index": variable_indices,
+                    "weights_cache_dir": os.path.join(rootdir, "weights_cache"),
+                }
+            },
+        }
+    return diagnostics_dict
+
+
 def get_project_rootdir(project):
     if project == "CMIP5":
         return CMIP5_ROOTDIR
@@ -573,7 +612,7 @@ def gen_s20_recipe():
     datasets = {"CMIP6": cmip6_datasets, "CMIP5": cmip5_datasets}
     for project, dataset in datasets.items():
         rootdir = get_project_rootdir(project)
-        diagnostic_dict = get_s20_diagnostic(rootdir)
+        diagnostic_dict = get_s20_multi_index_diagnostic(rootdir)
         script_dir = pathlib.Path(__file__).parent.resolve()
         recipe_fn = os.path.join(
             script_dir,
@@ -23,7 +23,10 @@ WORKDIR=/home/cenv0857/decadal-prediction-data-preparation
 esmvaltool run --skip-nonexistent=True --check_level=relaxed --offline=True $WORKDIR/esmvaltool-recipes/recipe_s20_cmip5_autogen.yml
 esmvaltool run --skip-nonexistent=True --check_level=relaxed --offline=True $WORKDIR/esmvaltool-recipes/recipe_s20_cmip6_autogen.yml
 
-# python $WORKDIR/03_process-ncar-prec-data.py --config $WORKDIR/arc-config.yml
+# python $WORKDIR/03_process-ncar-prec-data.py --config $WORKDIR/arc-config.yml --workers 48
+# or split over a SLURM array job, then merge the shards once all tasks have finished:
+# sbatch --array=0-15 --wrap "python $WORKDIR/03_process-ncar-prec-data.py --config $WORKDIR/arc-config.yml --workers 48 --shard slurm"
+# python $WORKDIR/03_process-ncar-prec-data.py --config $WORKDIR/arc-config.yml --merge-shards 16
 
 # esmvaltool run --skip-nonexistent=True --check_level=relaxed --offline=True ~/decadal-flood-prediction/esmvaltool-recipes/recipe_s20_grid_cmip5_autogen.yml
 # esmvaltool run --skip-nonexistent=True --check_level=relaxed --offline=True ~/decadal-flood-prediction/esmvaltool-recipes/recipe_s20_grid_cmip6_autogen.yml
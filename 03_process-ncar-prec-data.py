@@ -1,12 +1,31 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import sys
+import csv
+from time import perf_counter, process_time
+import functools
+import contextlib
 import glob
+import json
+import shutil
+import hashlib
+import cProfile
+import resource
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import numpy as np
+import scipy.sparse
+import dask
+import dask.array as da
 import iris
 import iris.pandas
 import iris.coord_categorisation
 import xarray
+from xarray.backends.locks import HDF5_LOCK
+import netCDF4
 import yaml
 import click
 
@@ -15,6 +34,38 @@ from tqdm import tqdm
 VALID_Y_NAMES = ["latitude", "lat"]
 VALID_X_NAMES = ["longitude", "lon"]
 VALID_TIME_NAMES = ["t", "time"]
+NCAR_VARIABLES = ["PRECC", "PRECL"]
+
+# Approximate number of copies of each input time step held at once while
+# loading and regridding lazily: the PRECC and PRECL chunks, their sum and
+# the filled and reshaped copies made by _apply_regridder
+LAZY_WORKING_SET = 6
+
+# Boxes (xmin, xmax, ymin, ymax) of the area-mean products
+BOXES = {
+    "european_precip": (-10, 25, 55, 70),
+    "uk_precip": (-8, 2, 50, 59),
+}
+
+# Output encoding policies selected with --encoding: "native" writes the
+# products as computed, "compressed" as deflated, byte-shuffled float32
+ENCODING_POLICIES = {
+    "native": {},
+    "compressed": {"dtype": "float32", "zlib": True, "complevel": 4, "shuffle": True},
+}
+
+# Upper bound on the size of an output chunk with time-series chunking
+ENCODING_CHUNK_BYTES = 2**20
+
+# Approximate size of the headers and metadata of a small NetCDF-4 file;
+# savings are not reported for files whose data is smaller than this
+NETCDF_FILE_OVERHEAD = 16 * 2**10
+
+# e.g. b.e11.BDP.f09_g16.1983-11.001.cam.h0.PRECC.198311-199312.nc
+CESM_DPLE_FILENAME = re.compile(
+    r"^b\.e11\.BDP\.\w+\.(?P<init_year>\d{4})-\d{2}\.(?P<member>\d{3})"
+    r"\.cam\.h0\.(?P<variable>\w+)\.\d{6}-\d{6}\.nc$"
+)
 
 
 def _get_latitude_name(x):
@@ -62,7 +113,150 @@ def _transform_longitude(xmin, xmax, positive_lon):
     return xmin, xmax
 
 
-def _regrid_cube(source, target):
+def _grid_hash(x):
+    # Hash of the horizontal grid of an Iris cube, used to key
+    # cached regridding weights and box masks
+    lat = x.coord(_get_latitude_name(x))
+    lon = x.coord(_get_longitude_name(x))
+    h = hashlib.sha1()
+    for coord in [lat, lon]:
+        h.update(np.ascontiguousarray(coord.points, dtype=np.float64).tobytes())
+        if coord.has_bounds():
+            h.update(np.ascontiguousarray(coord.bounds, dtype=np.float64).tobytes())
+    h.update(str(lon.circular).encode())
+    return h.hexdigest()
+
+
+def _linear_weights_1d(src, tgt, modulus=None, circular=False):
+    # Sparse (len(tgt), len(src)) matrix of linear interpolation weights
+    # along one axis, extrapolating linearly beyond the source range as
+    # iris.analysis.Linear() does by default
+    src = np.asarray(src, dtype=np.float64)
+    tgt = np.asarray(tgt, dtype=np.float64)
+    order = np.argsort(src)
+    src_sorted = src[order]
+    if circular:
+        # Interpolate across the wrap-around point
+        src_sorted = np.append(src_sorted, src_sorted[0] + modulus)
+        order = np.append(order, order[0])
+    if modulus:
+        # Map targets into a range centred on the source points,
+        # as Iris does for longitude
+        offset = 0.5 * (src_sorted[0] + src_sorted[-1] - modulus)
+        tgt = offset + _matlab_mod(tgt - offset, modulus)
+    i = np.searchsorted(src_sorted, tgt, side="right") - 1
+    i = np.clip(i, 0, len(src_sorted) - 2)
+    f = (tgt - src_sorted[i]) / (src_sorted[i + 1] - src_sorted[i])
+    rows = np.concatenate([np.arange(len(tgt)), np.arange(len(tgt))])
+    cols = np.concatenate([order[i], order[i + 1]])
+    vals = np.concatenate([1.0 - f, f])
+    weights = scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(len(tgt), len(src)))
+    return weights
+
+
+def _build_linear_regridder(source, target):
+    # Bilinear regridding on rectilinear grids is separable, so the full
+    # weights matrix is the Kronecker product of the 1D lat/lon weights
+    src_lat = source.coord(_get_latitude_name(source))
+    src_lon = source.coord(_get_longitude_name(source))
+    tgt_lat = target.coord(_get_latitude_name(target))
+    tgt_lon = target.coord(_get_longitude_name(target))
+    lat_weights = _linear_weights_1d(
+        src_lat.points, tgt_lat.points, modulus=src_lat.units.modulus
+    )
+    lon_weights = _linear_weights_1d(
+        src_lon.points,
+        tgt_lon.points,
+        modulus=src_lon.units.modulus,
+        circular=src_lon.circular,
+    )
+    weights = scipy.sparse.kron(lat_weights, lon_weights, format="csr")
+    return weights
+
+
+# Regridding weights for the current process, keyed by
+# (source grid hash, target grid hash, scheme)
+_REGRIDDERS = {}
+
+
+def _get_regridder(source, target, cache_dir=None, scheme="linear"):
+    key = (_grid_hash(source), _grid_hash(target), scheme)
+    if key in _REGRIDDERS:
+        return _REGRIDDERS[key]
+
+    cache_fn = None
+    if cache_dir is not None:
+        cache_fn = os.path.join(
+            cache_dir, "regrid_" + "_".join([key[0][:16], key[1][:16], scheme]) + ".npz"
+        )
+    if cache_fn is not None and os.path.exists(cache_fn):
+        weights = scipy.sparse.load_npz(cache_fn).tocsr()
+    else:
+        weights = _build_linear_regridder(source, target)
+        if cache_fn is not None:
+            # Write to a temporary file first so that concurrent
+            # workers never read a partially written cache
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_fn = cache_fn + "." + str(os.getpid()) + ".tmp.npz"
+            scipy.sparse.save_npz(tmp_fn, weights)
+            os.replace(tmp_fn, cache_fn)
+    _REGRIDDERS[key] = weights
+    return weights
+
+
+def _apply_regridder(weights, data, y_dim, x_dim, grid_shape):
+    # Apply precomputed weights over the (lat, lon) dimensions of `data`
+    data = np.moveaxis(data, [y_dim, x_dim], [-2, -1])
+    flat = data.reshape(-1, data.shape[-2] * data.shape[-1])
+    result = weights.dot(flat.T).T.astype(data.dtype, copy=False)
+    result = result.reshape(data.shape[:-2] + grid_shape)
+    return np.moveaxis(result, [-2, -1], [y_dim, x_dim])
+
+
+def _apply_regridder_lazy(weights, data, y_dim, x_dim, grid_shape):
+    # Regrid a dask array one chunk of the non-grid dimensions at a time.
+    # Masked points are filled with NaN so that any target point which
+    # depends on them is masked, as with iris.analysis.Linear()
+    data = data.rechunk({y_dim: -1, x_dim: -1})
+    data = da.ma.filled(data, np.nan)
+    chunks = list(data.chunks)
+    chunks[y_dim] = (grid_shape[0],)
+    chunks[x_dim] = (grid_shape[1],)
+    result = data.map_blocks(
+        functools.partial(
+            _apply_regridder,
+            weights,
+            y_dim=y_dim,
+            x_dim=x_dim,
+            grid_shape=grid_shape,
+        ),
+        chunks=tuple(chunks),
+        meta=np.array((), dtype=data.dtype),
+    )
+    return da.ma.masked_invalid(result)
+
+
+def _create_regridded_cube(data, source, target):
+    # Build the output cube from the source metadata and the target grid,
+    # dropping auxiliary coordinates that span the horizontal dimensions
+    lat_name = _get_latitude_name(source)
+    lon_name = _get_longitude_name(source)
+    grid_dims = source.coord_dims(lat_name) + source.coord_dims(lon_name)
+    cube = iris.cube.Cube(data)
+    cube.metadata = source.metadata
+    for coord in source.dim_coords:
+        dims = source.coord_dims(coord)
+        if dims[0] in grid_dims:
+            coord = target.coord(coord.name())
+        cube.add_dim_coord(coord.copy(), dims)
+    for coord in source.aux_coords:
+        dims = source.coord_dims(coord)
+        if not set(dims).intersection(grid_dims):
+            cube.add_aux_coord(coord.copy(), dims)
+    return cube
+
+
+def _regrid_cube(source, target, cache_dir=None):
     # Ensure grid coords have the same name
     target_lon_name = _get_longitude_name(target)
     target_lat_name = _get_latitude_name(target)
@@ -75,43 +269,175 @@ def _regrid_cube(source, target):
     for coord_nm in [target_lat_name, target_lon_name]:
         source.coord(coord_nm).coord_system = target.coord(coord_nm).coord_system
 
-    # Perform the regridding
-    regrid_source = source.regrid(target, iris.analysis.Linear())
+    # Masked points in realised data need Iris' own mask handling
+    if not source.has_lazy_data() and np.ma.is_masked(source.data):
+        regrid_source = source.regrid(target, iris.analysis.Linear())
+        return regrid_source
+
+    # Perform the regridding with cached weights
+    weights = _get_regridder(source, target, cache_dir)
+    y_dim = source.coord_dims(target_lat_name)[0]
+    x_dim = source.coord_dims(target_lon_name)[0]
+    grid_shape = (
+        target.coord(target_lat_name).shape[0],
+        target.coord(target_lon_name).shape[0],
+    )
+    if source.has_lazy_data():
+        data = _apply_regridder_lazy(
+            weights, source.lazy_data(), y_dim, x_dim, grid_shape
+        )
+    else:
+        data = _apply_regridder(
+            weights, np.ma.getdata(source.data), y_dim, x_dim, grid_shape
+        )
+        data = np.ma.asarray(data)
+    regrid_source = _create_regridded_cube(data, source, target)
     return regrid_source
 
 
-def _extract_ts(x, xmin, xmax, ymin, ymax):
-    # work on a copy
-    x_copy = x.copy()
-    lon_name = _get_longitude_name(x_copy)
-    lat_name = _get_latitude_name(x_copy)
-    if x_copy.coord(lon_name).bounds is None:
-        x_copy.coord(lon_name).guess_bounds()
-    if x_copy.coord(lat_name).bounds is None:
-        x_copy.coord(lat_name).guess_bounds()
-    positive_lon = _has_positive_longitude(x_copy)
-    xmin, xmax = _transform_longitude(xmin, xmax, positive_lon)
-    box = x_copy.intersection(longitude=(xmin, xmax), latitude=(ymin, ymax))
+# _build_box_weights and _apply_box_weights are also copied in
+# esmvaltool-recipes/diag_scripts/utils.py; fixes must be made in both
+def _build_box_weights(x, xmin, xmax, ymin, ymax):
+    # Run the Iris intersection once on a template cube holding the flat
+    # index of each grid cell, so that the selected cells (including any
+    # longitude wraparound) match Cube.intersection exactly
+    lat = x.coord(_get_latitude_name(x)).copy()
+    lon = x.coord(_get_longitude_name(x)).copy()
+    if lon.bounds is None:
+        lon.guess_bounds()
+    if lat.bounds is None:
+        lat.guess_bounds()
+    shape = (lat.shape[0], lon.shape[0])
+    template = iris.cube.Cube(np.arange(shape[0] * shape[1]).reshape(shape))
+    template.add_dim_coord(lat, 0)
+    template.add_dim_coord(lon, 1)
+    box = template.intersection(longitude=(xmin, xmax), latitude=(ymin, ymax))
     grid_areas = iris.analysis.cartography.area_weights(box)
-    ts = box.collapsed(
-        ["latitude", "longitude"], iris.analysis.MEAN, weights=grid_areas
+    weights = np.zeros(shape[0] * shape[1])
+    np.add.at(weights, box.data.ravel(), grid_areas.ravel())
+    weights = weights.reshape(shape) / weights.sum()
+
+    # Scalar coordinates of the collapsed box
+    box = box.collapsed(
+        [lat.name(), lon.name()], iris.analysis.MEAN, weights=grid_areas
     )
+    box_coords = [box.coord(lat.name()), box.coord(lon.name())]
+    return weights, box_coords
+
+
+# Normalized area weights for each (grid hash, box) in the current process
+_BOX_WEIGHTS = {}
+
+
+def _get_box_weights(x, xmin, xmax, ymin, ymax):
+    key = (_grid_hash(x), xmin, xmax, ymin, ymax)
+    if key not in _BOX_WEIGHTS:
+        _BOX_WEIGHTS[key] = _build_box_weights(x, xmin, xmax, ymin, ymax)
+    return _BOX_WEIGHTS[key]
+
+
+def _apply_box_weights(data, weights, y_dim, x_dim):
+    # Weighted box mean over the (lat, lon) dimensions of `data`; masked
+    # points are excluded by renormalizing over the unmasked weights
+    axes = ([y_dim, x_dim], [0, 1])
+    if not np.ma.is_masked(data):
+        return np.tensordot(np.ma.getdata(data), weights, axes=axes)
+    mask = np.ma.getmaskarray(data)
+    total = np.tensordot(np.ma.filled(data, 0), weights, axes=axes)
+    norm = np.tensordot(~mask, weights, axes=axes)
+    mean = np.divide(total, norm, out=np.zeros_like(total), where=norm > 0)
+    return np.ma.masked_where(norm == 0, mean)
+
+
+def _get_ts_weights(x, xmin, xmax, ymin, ymax):
+    # Box weights for `x`, with the box given in standard longitudes
+    positive_lon = _has_positive_longitude(x)
+    xmin, xmax = _transform_longitude(xmin, xmax, positive_lon)
+    return _get_box_weights(x, xmin, xmax, ymin, ymax)
+
+
+def _extract_ts(x, xmin, xmax, ymin, ymax):
+    lon_name = _get_longitude_name(x)
+    lat_name = _get_latitude_name(x)
+    weights, box_coords = _get_ts_weights(x, xmin, xmax, ymin, ymax)
+    y_dim = x.coord_dims(lat_name)[0]
+    x_dim = x.coord_dims(lon_name)[0]
+    data = _apply_box_weights(x.data, weights, y_dim, x_dim)
+
+    # Take the remaining coordinates from a single grid point
+    index = [slice(None)] * x.ndim
+    index[y_dim] = 0
+    index[x_dim] = 0
+    ts = x[tuple(index)]
+    for coord in box_coords:
+        ts.remove_coord(coord.name())
+        ts.add_aux_coord(coord.copy())
+    ts.data = data
+    ts.add_cell_method(iris.coords.CellMethod("mean", coords=[lat_name, lon_name]))
     return ts
 
 
 def _extract_european_precip_ts(x):
-    europe_prec = _extract_ts(x, -10, 25, 55, 70)
+    europe_prec = _extract_ts(x, *BOXES["european_precip"])
     return europe_prec
 
 
 def _extract_uk_precip_ts(x):
-    uk_prec = _extract_ts(x, -8, 2, 50, 59)
+    uk_prec = _extract_ts(x, *BOXES["uk_precip"])
     return uk_prec
 
 
+def _build_field_index(x, xmin, xmax, ymin, ymax):
+    # As for the box weights, run the Iris intersection on a template cube
+    # of flat cell indices, and turn the selected cells into a latitude
+    # slice and one longitude slice per contiguous run of cells (two when
+    # the box crosses the longitude wraparound)
+    lat = x.coord(_get_latitude_name(x)).copy()
+    lon = x.coord(_get_longitude_name(x)).copy()
+    shape = (lat.shape[0], lon.shape[0])
+    template = iris.cube.Cube(np.arange(shape[0] * shape[1]).reshape(shape))
+    template.add_dim_coord(lat, 0)
+    template.add_dim_coord(lon, 1)
+    box = template.intersection(longitude=(xmin, xmax), latitude=(ymin, ymax))
+    rows = box.data[:, 0] // shape[1]
+    cols = box.data[0, :] % shape[1]
+    lat_index = slice(rows[0], rows[-1] + 1)
+    if np.any(np.diff(rows) != 1):
+        lat_index = rows
+    runs = np.split(cols, np.flatnonzero(np.diff(cols) != 1) + 1)
+    lon_slices = [slice(run[0], run[-1] + 1) for run in runs]
+    box_coords = [box.coord(lat.name()), box.coord(lon.name())]
+    return lat_index, lon_slices, box_coords
+
+
+# Index of the cells of each (grid hash, box) in the current process
+_FIELD_INDEX = {}
+
+
+def _get_field_index(x, xmin, xmax, ymin, ymax):
+    key = (_grid_hash(x), xmin, xmax, ymin, ymax)
+    if key not in _FIELD_INDEX:
+        _FIELD_INDEX[key] = _build_field_index(x, xmin, xmax, ymin, ymax)
+    return _FIELD_INDEX[key]
+
+
 def _extract_field(x, xmin, xmax, ymin, ymax):
-    x_copy = x.copy()
-    subset = x_copy.intersection(longitude=(xmin, xmax), latitude=(ymin, ymax))
+    # Index the box directly rather than copying the whole field for
+    # Cube.intersection, so that only the box itself is copied; a box
+    # crossing the wraparound is indexed by the cells of its two slices
+    # and given the longitudes Cube.intersection would give it
+    lat_index, lon_slices, box_coords = _get_field_index(x, xmin, xmax, ymin, ymax)
+    y_dim = x.coord_dims(_get_latitude_name(x))[0]
+    x_dim = x.coord_dims(_get_longitude_name(x))[0]
+    index = [slice(None)] * x.ndim
+    index[y_dim] = lat_index
+    index[x_dim] = lon_slices[0]
+    if len(lon_slices) > 1:
+        index[x_dim] = np.concatenate([np.arange(s.start, s.stop) for s in lon_slices])
+    subset = x[tuple(index)]
+    for coord, dim in zip(box_coords, [y_dim, x_dim]):
+        subset.remove_coord(coord.name())
+        subset.add_dim_coord(coord.copy(), dim)
     return subset
 
 
@@ -150,7 +476,82 @@ def _extract_precip_field(x):
 #     df.reset_index()
 #     return df
 
-def _get_filename(path, init_year, member, variable):
+def _scan_ncar_files(path, variables):
+    # Parse every CESM-DPLE filename under `path` with a single directory
+    # listing per variable, rather than a glob per lookup
+    file_index = {}
+    for variable in variables:
+        with os.scandir(os.path.join(path, variable)) as entries:
+            for entry in entries:
+                m = CESM_DPLE_FILENAME.match(entry.name)
+                if m is None or m.group("variable") != variable:
+                    continue
+                key = (variable, int(m.group("init_year")), int(m.group("member")))
+                file_index.setdefault(key, []).append(entry.path)
+    return file_index
+
+
+def _directory_mtimes(path, variables):
+    return {v: os.stat(os.path.join(path, v)).st_mtime_ns for v in variables}
+
+
+def _load_file_index(path, variables, sidecar=None):
+    # Reuse a JSON sidecar index unless one of the
+    # variable directories has changed since it was written
+    mtimes = _directory_mtimes(path, variables)
+    if sidecar is not None and os.path.exists(sidecar):
+        with open(sidecar, "r") as f:
+            saved = json.load(f)
+        if saved["path"] == path and saved["mtimes"] == mtimes:
+            file_index = {}
+            for variable, init_year, member, filenames in saved["files"]:
+                file_index[(variable, init_year, member)] = filenames
+            return file_index
+
+    file_index = _scan_ncar_files(path, variables)
+    if sidecar is not None:
+        saved = {
+            "path": path,
+            "mtimes": mtimes,
+            "files": [list(key) + [fns] for key, fns in sorted(file_index.items())],
+        }
+        with open(sidecar, "w") as f:
+            json.dump(saved, f)
+    return file_index
+
+
+def _check_file_index(file_index, units, variables):
+    # Find units with missing or duplicate input files before processing
+    problems = {}
+    for init_year, member in units:
+        msgs = []
+        for variable in variables:
+            n = len(file_index.get((variable, init_year, member), []))
+            if n == 0:
+                msgs.append("no " + variable + " file")
+            elif n > 1:
+                msgs.append(str(n) + " " + variable + " files")
+        if len(msgs) > 0:
+            problems[(init_year, member)] = ", ".join(msgs)
+    return problems
+
+
+def _get_filename(path, init_year, member, variable, file_index=None):
+    if file_index is not None:
+        f = file_index.get((variable, init_year, member), [])
+        if len(f) != 1:
+            raise ValueError(
+                "Expected exactly one "
+                + variable
+                + " file for init_year="
+                + str(init_year)
+                + " member="
+                + str(member)
+                + ", found "
+                + str(len(f))
+            )
+        return f[0]
+
     ptn = (
         path
         + "/"
@@ -164,44 +565,109 @@ def _get_filename(path, init_year, member, variable):
         + "*.nc"
     )
     f = glob.glob(ptn)
-    if len(f) != 1:
-        raise
+    if len(f) == 0:
+        raise FileNotFoundError("No file matches " + ptn)
+    if len(f) > 1:
+        raise ValueError(
+            "Expected exactly one file matching " + ptn + ", found " + str(len(f))
+        )
     return f[0]
 
 
-def _compute_djfm(
-    x, init_year, start_year=2, end_year=9
-):  # , varname, init_year, start_year=2, end_year=9):
-    da = xarray.DataArray.from_iris(x)
-    varname = str(da.name)
-    ds = da.to_dataset()
-    time_dimname = "time"
-    ds["counter"] = (
-        (time_dimname,),
-        [
-            1,
-        ]
-        * len(ds.time),
-    )
-    ds = ds.groupby("season_year").sum(time_dimname)
-    # Limit dataset to complete [boreal winter] seasons
-    complete_index = ds["counter"].values == 4
-    ds = ds.sel(season_year=complete_index)
-    # Divide by four to get mean value, unless precipitation
-    ds[varname] = ds[varname] / 4
-    # Add lead time
-    # [N.B. season_year (added automatically by Iris)
-    # defines the year of final month in the season]
-    ds["lead_time"] = (("season_year",), ds.season_year.values - int(init_year))
-
-    def _is_yr2to9(year):  # , init_year):
-        return (year >= start_year) & (year <= end_year)
-
-    ds = ds.sel(season_year=_is_yr2to9(ds["lead_time"]))
-    # ds = ds.drop(['counter','lead_time'])
-    ds = ds.mean("season_year")
-    # da = ds[varname].to_iris()
-    return ds[varname]
+# The season helpers below are also copied in
+# esmvaltool-recipes/diag_scripts/utils.py; fixes must be made in both
+def _season_months(season):
+    # First month (1 to 12) and number of months of a season of
+    # contiguous months named by their initials, e.g. "djfm" or "jjas"
+    months = "jfmamjjasond"
+    first = (months * 2).find(season.lower())
+    if len(season) == 0 or len(season) > 12 or first < 0:
+        raise ValueError("Unrecognised season " + season)
+    return first + 1, len(season)
+
+
+def _season_index(years, months, season):
+    # Position along time of each month of each season, as a (season year,
+    # month of season) array holding -1 for missing or repeated months. As
+    # with Iris' season_year, seasons are labelled by the year of their
+    # final month
+    first, length = _season_months(season)
+    offset = (months - first) % 12
+    steps = np.flatnonzero(offset < length)
+    if steps.size == 0:
+        return np.zeros(0, dtype=int), np.zeros((0, length), dtype=int)
+    offset = offset[steps]
+    season_years = years[steps] + (months[steps] + length - 2 - offset) // 12
+    rows = season_years - season_years.min()
+    index = np.full((rows.max() + 1, length), -1)
+    counts = np.zeros(index.shape, dtype=int)
+    np.add.at(counts, (rows, offset), 1)
+    index[rows, offset] = steps
+    index[counts > 1] = -1
+    return np.arange(season_years.min(), season_years.max() + 1), index
+
+
+def _seasonal_means(data, index, time_axis=0):
+    # Mean of `data` over the months of each complete season of `index`
+    # (see _season_index), along a leading season axis, and the mask of
+    # complete seasons. When the seasons are consecutive months a year
+    # apart they are taken as sliding windows over a view of the data,
+    # otherwise (e.g. a non-monotonic time) their months are gathered.
+    # A season with a masked month is NaN
+    complete = np.all(index >= 0, axis=1)
+    rows = index[complete]
+    data = np.moveaxis(data, time_axis, 0)
+    if np.ma.is_masked(data):
+        data = np.ma.filled(data, np.nan)
+    else:
+        data = np.ma.getdata(data)
+    starts = rows[:, 0]
+    length = index.shape[1]
+    if (
+        starts.size > 0
+        and np.all(rows == starts[:, None] + np.arange(length))
+        and np.all(np.diff(starts) == 12)
+    ):
+        windows = np.lib.stride_tricks.sliding_window_view(data, length, axis=0)
+        means = windows[starts[0] : starts[-1] + 1 : 12].mean(axis=-1)
+    else:
+        means = data[rows].mean(axis=1)
+    return means, complete
+
+
+def _compute_season_mean(x, init_year, season, start_year=2, end_year=9):
+    # Mean of an Iris cube over its complete `season`s with lead times
+    # (season year - `init_year`) from `start_year` to `end_year`. The
+    # seasons are found from the time coordinate itself, which may lie
+    # along an anonymous dimension when the time is non-monotonic
+    time = x.coord(_get_time_name(x))
+    time_dim = x.coord_dims(time)[0]
+    dates = time.units.num2date(time.points)
+    years = np.array([date.year for date in dates])
+    months = np.array([date.month for date in dates])
+    season_years, index = _season_index(years, months, season)
+    means, complete = _seasonal_means(x.data, index, time_dim)
+    lead_time = season_years[complete] - int(init_year)
+    selected = (lead_time >= start_year) & (lead_time <= end_year)
+    data = means[selected].mean(axis=0)
+
+    # Take the metadata from a single time step, less the coordinates
+    # along time, which are removed first from a copy sharing the data
+    mean = x.copy(data=x.core_data())
+    for coord in x.coords(dimensions=time_dim):
+        mean.remove_coord(coord.name())
+    head = [slice(None)] * x.ndim
+    head[time_dim] = 0
+    mean = mean[tuple(head)]
+    mean.data = np.ma.masked_invalid(data) if np.ma.is_masked(x.data) else data
+    return mean
+
+
+def _compute_djfm(x, init_year, start_year=2, end_year=9):
+    # Mean over the DJFM seasons with lead times from
+    # `start_year` to `end_year`, as an xarray DataArray
+    mean = _compute_season_mean(x, init_year, "djfm", start_year, end_year)
+    return xarray.DataArray.from_iris(mean)
 
 
 def _get_output_filename(
@@ -226,9 +692,1502 @@ def _get_output_filename(
     return fn
 
 
+def _get_output_dirs(output_dir):
+    # Output directories for each product, following the
+    # ESMValTool work directory layout
+    output_dirs = {
+        "european_precip": os.path.join(
+            output_dir, "recipe1/work/european_precip/european_precip"
+        ),
+        "uk_precip": os.path.join(output_dir, "recipe1/work/uk_precip/uk_precip"),
+        # "uk_precip_field": os.path.join(
+        #     output_dir, "recipe1/work/uk_precip_field/uk_precip_field"
+        # ),
+        "precip_field": os.path.join(
+            output_dir, "recipe1/work/precip_field/precip_field"
+        ),
+    }
+    return output_dirs
+
+
+def _get_encoding_policy(options):
+    # Encoding policy from the --encoding, --chunking and
+    # --significant-digits options
+    policy = dict(ENCODING_POLICIES[options["encoding"]])
+    if options["significant_digits"] is not None:
+        policy["significant_digits"] = options["significant_digits"]
+    if len(policy) > 0:
+        policy["chunking"] = options["chunking"]
+    return policy
+
+
+def _encoding_chunks(sizes, chunking, itemsize):
+    # Chunk shape for dimensions `sizes` (time first). "time" chunking keeps
+    # whole time series together, tiling the other dimensions so that a
+    # chunk stays within ENCODING_CHUNK_BYTES; "map" chunking holds one
+    # time step of every other dimension per chunk
+    sizes = list(sizes)
+    if chunking == "map":
+        return [1] + sizes[1:]
+    chunks = list(sizes)
+    while np.prod(chunks) * itemsize > ENCODING_CHUNK_BYTES:
+        # Halve the largest of the other dimensions
+        i = 1 + int(np.argmax(chunks[1:])) if len(chunks) > 1 else 0
+        if i == 0 or chunks[i] == 1:
+            break
+        chunks[i] = (chunks[i] + 1) // 2
+    return chunks
+
+
+def _get_encoding(product, policy):
+    # xarray encoding for a time-first product under an encoding policy
+    encoding = {k: v for k, v in policy.items() if k != "chunking"}
+    itemsize = np.dtype(policy.get("dtype", product.dtype)).itemsize
+    chunks = _encoding_chunks(product.shape, policy["chunking"], itemsize)
+    encoding["chunksizes"] = tuple(chunks)
+    return {product.name: encoding}
+
+
+def _write_product(product, filename, policy):
+    encoding = {}
+    if len(policy) > 0:
+        product = product.transpose("time", ...)
+        encoding = _get_encoding(product, policy)
+    product.to_netcdf(filename, encoding=encoding)
+
+
+# Per-stage resource usage of the unit being processed by each thread of
+# this process, in its `profile` attribute (None when profiling is off);
+# see _profiling and _profile_stage
+_PROFILE = threading.local()
+
+PROFILE_FIELDS = ["calls", "wall", "cpu", "read_bytes", "write_bytes", "peak_rss"]
+
+
+def _resource_usage():
+    # Wall and CPU time, and bytes read and written through
+    # system calls (Linux only), of this process
+    usage = {
+        "wall": perf_counter(),
+        "cpu": process_time(),
+        "read_bytes": 0,
+        "write_bytes": 0,
+    }
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key == "rchar":
+                    usage["read_bytes"] = int(value)
+                elif key == "wchar":
+                    usage["write_bytes"] = int(value)
+    except OSError:
+        pass
+    return usage
+
+
+# Peak RSS of the stages open in this process, in any thread. The RSS
+# high-water mark is reset when a stage starts (Linux only), after it has
+# been folded into every stage still open, so that each stage reports its
+# own peak rather than that of the process so far
+_OPEN_PEAKS = []
+_PEAK_LOCK = threading.Lock()
+
+
+def _read_peak_rss():
+    # RSS high-water mark since it was last reset, or
+    # since the process started if it cannot be reset
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    return peak_rss
+
+
+def _fold_peak_rss():
+    peak_rss = _read_peak_rss()
+    for record in _OPEN_PEAKS:
+        record["peak_rss"] = max(record["peak_rss"], peak_rss)
+
+
+def _start_usage():
+    # Resource usage at the start of a stage, resetting the RSS high-water
+    # mark; the stage's peak is recorded until it is passed to _add_usage
+    usage = _resource_usage()
+    with _PEAK_LOCK:
+        _fold_peak_rss()
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+        usage["peak"] = {"peak_rss": _read_peak_rss()}
+        _OPEN_PEAKS.append(usage["peak"])
+    return usage
+
+
+def _add_usage(profile, stage, start, end):
+    # Accumulate the usage between `start` (from _start_usage)
+    # and `end` into `profile`
+    with _PEAK_LOCK:
+        _fold_peak_rss()
+        _OPEN_PEAKS[:] = [peak for peak in _OPEN_PEAKS if peak is not start["peak"]]
+    record = profile.setdefault(stage, {field: 0 for field in PROFILE_FIELDS})
+    record["calls"] += 1
+    for field in ["wall", "cpu", "read_bytes", "write_bytes"]:
+        record[field] += end[field] - start[field]
+    record["peak_rss"] = max(record["peak_rss"], start["peak"]["peak_rss"])
+
+
+@contextlib.contextmanager
+def _profiling(profile):
+    # Record stages run by this thread into `profile` (None to stop
+    # recording). CPU time and bytes are per process, so with --prefetch
+    # they include the work of the reader and writer threads
+    _PROFILE.profile = profile
+    try:
+        yield
+    finally:
+        _PROFILE.profile = None
+
+
+@contextlib.contextmanager
+def _profile_stage(stage):
+    # Record the resource usage of a stage of the current unit
+    profile = getattr(_PROFILE, "profile", None)
+    if profile is None:
+        yield
+        return
+    start = _start_usage()
+    try:
+        yield
+    finally:
+        _add_usage(profile, stage, start, _resource_usage())
+
+
+def _write_profile(rows, profile_fn):
+    # Write per-unit stage records as CSV, or as JSON
+    # together with the totals for each stage
+    if profile_fn.endswith(".csv"):
+        with open(profile_fn, "w", newline="") as f:
+            writer = csv.DictWriter(
+                f, fieldnames=["init_year", "member", "stage"] + PROFILE_FIELDS
+            )
+            writer.writeheader()
+            writer.writerows(rows)
+        return
+    totals = {}
+    for row in rows:
+        total = totals.setdefault(row["stage"], {field: 0 for field in PROFILE_FIELDS})
+        for field in PROFILE_FIELDS:
+            if field == "peak_rss":
+                total[field] = max(total[field], row[field])
+            else:
+                total[field] += row[field]
+    with open(profile_fn, "w") as f:
+        json.dump({"units": rows, "totals": totals}, f, indent=2)
+
+
+def _get_time_chunk(xr_source, max_memory):
+    # Number of time steps per chunk that keeps the working
+    # set of a lazy load within `max_memory` megabytes
+    step_bytes = xr_source.dtype.itemsize
+    for dim, size in xr_source.sizes.items():
+        if dim != "time":
+            step_bytes *= size
+    n = int(max_memory * 2**20 // (LAZY_WORKING_SET * step_bytes))
+    return max(1, min(n, xr_source.sizes["time"]))
+
+
+# Sources of the batch being processed, read into memory ahead of time by
+# the --prefetch reader thread, keyed by (filename, variable)
+_PREFETCHED = {}
+
+
+def _read_source(source_fn, variable):
+    with xarray.open_dataset(source_fn) as ds:
+        return ds[variable].load()
+
+
+def _open_source(
+    ncar_path, init_year, member, variable, file_index=None, max_memory=None
+):
+    source_fn = _get_filename(ncar_path, init_year, member, variable, file_index)
+    # source_fn = 'data-raw/ncar_prec_data/b.e11.BDP.f09_g16.1983-11.001.cam.h0.PRECC.198311-199312.nc'
+    if (source_fn, variable) in _PREFETCHED:
+        return _PREFETCHED[source_fn, variable]
+    xr_source = xarray.open_dataset(source_fn)[variable]
+    if max_memory is not None:
+        # Read lazily in chunks along time, rather than loading the
+        # whole file, so that memory use depends on the chunk size
+        time_chunk = _get_time_chunk(xr_source, max_memory)
+        xr_source = xr_source.chunk({"time": time_chunk})
+    return xr_source
+
+
+def _load_source(
+    ncar_path, init_year, member, variable, file_index=None, max_memory=None
+):
+    with _profile_stage("load"):
+        xr_source = _open_source(
+            ncar_path, init_year, member, variable, file_index, max_memory
+        )
+        source = xr_source.to_iris()
+    return source
+
+
+def _extract_products(ds):
+    # Summarise a regridded precipitation cube as the
+    # products written by this script
+    # iris.coord_categorisation.add_season(
+    #     # ds, "time", seasons=["djfm", "am", "jjas", "on"]
+    #     ds, "time", seasons=["sondjfm", "amjja"]
+    # )
+    # iris.coord_categorisation.add_season_year(
+    #     # ds, "time", seasons=["djfm", "am", "jjas", "on"]
+    #     ds, "time", seasons=["sondjfm", "amjja"]
+    # )
+    # ds = ds.extract(iris.Constraint(season="sondjfm"))
+    products = {}
+
+    # European precip
+    european_precip = _extract_european_precip_ts(ds)
+    products["european_precip"] = xarray.DataArray.from_iris(european_precip)
+
+    # UK precip
+    uk_precip = _extract_uk_precip_ts(ds)
+    products["uk_precip"] = xarray.DataArray.from_iris(uk_precip)
+
+    # # UK precip field
+    # uk_precip_field = _extract_uk_precip_field(ds)
+    # products["uk_precip_field"] = xarray.DataArray.from_iris(uk_precip_field)
+
+    # Global precip field
+    precip_field = _extract_precip_field(ds)
+    products["precip_field"] = xarray.DataArray.from_iris(precip_field)
+    return products
+
+
+def _summarise_two_pass(sources, target, cache_dir=None):
+    # Regrid and summarise PRECC and PRECL separately, then add them
+    products = {}
+    for source in sources:
+        with _profile_stage("regrid"):
+            ds = _regrid_cube(source, target, cache_dir)
+        with _profile_stage("extract"):
+            source_products = _extract_products(ds)
+        for name, product in source_products.items():
+            if name in products:
+                products[name] = products[name] + product
+            else:
+                products[name] = product
+    return products
+
+
+def _summarise_fused(precc, precl, target, cache_dir=None):
+    # Regridding and area means are linear, so the total precipitation
+    # can be formed on the native grid and summarised in a single pass
+    if precc.coords() != precl.coords():
+        raise ValueError("PRECC and PRECL are not on the same grid and time axis")
+    source = precc.copy(data=precc.core_data() + precl.core_data())
+    # Keep only the names and attributes shared by PRECC and PRECL, as
+    # when the two-pass products are added, so that both give the same
+    # metadata
+    for name in ["standard_name", "long_name", "var_name"]:
+        if getattr(precc, name) != getattr(precl, name):
+            setattr(source, name, None)
+    source.attributes = {
+        k: v
+        for k, v in precc.attributes.items()
+        if k in precl.attributes and np.array_equal(v, precl.attributes[k])
+    }
+    with _profile_stage("regrid"):
+        ds = _regrid_cube(source, target, cache_dir)
+    with _profile_stage("extract"):
+        return _extract_products(ds)
+
+
+def _compute_two_pass(ncar_path, init_year, member, target, options, file_index=None):
+    sources = [
+        _load_source(
+            ncar_path, init_year, member, variable, file_index, options["max_memory"]
+        )
+        for variable in NCAR_VARIABLES
+    ]
+    return _summarise_two_pass(sources, target, options["regrid_cache_dir"])
+
+
+def _compute_fused(ncar_path, init_year, member, target, options, file_index=None):
+    precc, precl = [
+        _load_source(
+            ncar_path, init_year, member, variable, file_index, options["max_memory"]
+        )
+        for variable in NCAR_VARIABLES
+    ]
+    return _summarise_fused(precc, precl, target, options["regrid_cache_dir"])
+
+
+# Templates and weights for the numpy engine, keyed by (source grid hash,
+# target grid hash, fused, source metadata)
+_NUMPY_TEMPLATES = {}
+
+
+def _get_numpy_template(sources, target, cache_dir=None, fuse=True):
+    # Run the Iris engine once on the first time step of the sources. Its
+    # products are kept as templates for the metadata and non-time
+    # coordinates, together with the regridding and box weights that the
+    # numpy engine applies to every time step
+    heads = [source.isel(time=slice(0, 1)).to_iris() for source in sources]
+    key = (
+        _grid_hash(heads[0]),
+        _grid_hash(target),
+        fuse,
+        repr([(source.name, source.attrs) for source in sources]),
+    )
+    if key in _NUMPY_TEMPLATES:
+        return _NUMPY_TEMPLATES[key]
+
+    grid = _regrid_cube(heads[0].copy(), target, cache_dir)
+    lat_name = _get_latitude_name(grid)
+    lon_name = _get_longitude_name(grid)
+    if fuse:
+        products = _summarise_fused(*heads, target, cache_dir)
+    else:
+        products = _summarise_two_pass(heads, target, cache_dir)
+    template = {
+        "products": products,
+        "weights": _get_regridder(heads[0], target, cache_dir),
+        "boxes": {name: _get_ts_weights(grid, *box)[0] for name, box in BOXES.items()},
+        "y_dim": grid.coord_dims(lat_name)[0],
+        "x_dim": grid.coord_dims(lon_name)[0],
+        "grid_shape": (grid.coord(lat_name).shape[0], grid.coord(lon_name).shape[0]),
+    }
+    _NUMPY_TEMPLATES[key] = template
+    return template
+
+
+def _iris_time(time):
+    # Time coordinate as converted by Iris, so that both
+    # engines write the same time units and calendar
+    cube = xarray.DataArray(np.zeros(time.size), coords={"time": time}).to_iris()
+    return xarray.DataArray.from_iris(cube)["time"]
+
+
+def _fill_template(template, data, time):
+    # Product with the metadata of `template` and the given data and times
+    coords = {k: v for k, v in template.coords.items() if "time" not in v.dims}
+    coords["time"] = time
+    return xarray.DataArray(
+        data,
+        dims=template.dims,
+        coords=coords,
+        attrs=template.attrs,
+        name=template.name,
+    )
+
+
+def _same_grid(a, b):
+    # Whether two xarray sources share their dimensions and coordinates
+    return a.dims == b.dims and all(a[dim].equals(b[dim]) for dim in a.dims)
+
+
+def _open_numpy_sources(ncar_path, init_year, member, options, file_index=None):
+    with _profile_stage("load"):
+        sources = [
+            _open_source(
+                ncar_path,
+                init_year,
+                member,
+                variable,
+                file_index,
+                options["max_memory"],
+            )
+            for variable in NCAR_VARIABLES
+        ]
+    for source in sources[1:]:
+        if not _same_grid(source, sources[0]):
+            raise ValueError("PRECC and PRECL are not on the same grid and time axis")
+    return sources
+
+
+def _numpy_fields(sources, fuse=True):
+    # The fields to regrid: the total precipitation, or each variable
+    with _profile_stage("load"):
+        if fuse:
+            return [sources[0].data + sources[1].data]
+        return [source.data for source in sources]
+
+
+def _summarise_numpy(template, fields, n_batch_dims=0):
+    # Regrid each field with the template weights, add them, and form the
+    # data of each product. Fields may have `n_batch_dims` leading
+    # dimensions (e.g. members) ahead of those of the template source
+    y_dim = template["y_dim"] + n_batch_dims
+    x_dim = template["x_dim"] + n_batch_dims
+
+    # NaNs mark missing points, which are masked in the regridded field
+    # as with the Iris engine
+    regridded = None
+    with _profile_stage("regrid"):
+        for field in fields:
+            if isinstance(field, da.Array):
+                field = _apply_regridder_lazy(
+                    template["weights"], field, y_dim, x_dim, template["grid_shape"]
+                ).compute()
+            else:
+                field = _apply_regridder(
+                    template["weights"], field, y_dim, x_dim, template["grid_shape"]
+                )
+            field = np.ma.masked_invalid(field)
+            regridded = field if regridded is None else regridded + field
+
+    data = {}
+    with _profile_stage("extract"):
+        for name in template["products"]:
+            if name in template["boxes"]:
+                values = _apply_box_weights(
+                    regridded, template["boxes"][name], y_dim, x_dim
+                )
+            else:
+                values = regridded
+            data[name] = np.ma.filled(values, np.nan)
+    return data
+
+
+def _fill_templates(template, data, time_coord):
+    with _profile_stage("extract"):
+        return {
+            name: _fill_template(product, data[name], time_coord)
+            for name, product in template["products"].items()
+        }
+
+
+def _compute_numpy(
+    ncar_path, init_year, member, target, options, file_index=None, fuse=True
+):
+    # Regrid and summarise with NumPy on the arrays read by xarray, using
+    # Iris only for the per-grid template built by _get_numpy_template
+    sources = _open_numpy_sources(ncar_path, init_year, member, options, file_index)
+    with _profile_stage("template"):
+        template = _get_numpy_template(
+            sources, target, options["regrid_cache_dir"], fuse
+        )
+    data = _summarise_numpy(template, _numpy_fields(sources, fuse))
+    return _fill_templates(template, data, _iris_time(sources[0]["time"]))
+
+
+def _compute_numpy_batch(
+    ncar_path, init_year, members, target, options, file_index=None, fuse=True
+):
+    # Regrid and summarise several members of one initialization year,
+    # stacked along a leading dimension so that the regridding is a single
+    # sparse matrix product. Returns the products, or the error, of each
+    # member; members on another grid or time axis than the first are
+    # computed on their own
+    results = {}
+    sources = {}
+    for member in members:
+        try:
+            sources[member] = _open_numpy_sources(
+                ncar_path, init_year, member, options, file_index
+            )
+        except Exception as e:
+            results[member] = e
+    if len(sources) == 0:
+        return results
+
+    first = next(iter(sources.values()))
+    with _profile_stage("template"):
+        template = _get_numpy_template(first, target, options["regrid_cache_dir"], fuse)
+    batch = []
+    for member, member_sources in sources.items():
+        if _same_grid(member_sources[0], first[0]):
+            batch.append(member)
+            continue
+        try:
+            results[member] = _compute_numpy(
+                ncar_path, init_year, member, target, options, file_index, fuse
+            )
+        except Exception as e:
+            results[member] = e
+
+    fields = [_numpy_fields(sources[member], fuse) for member in batch]
+    stack = da.stack if isinstance(fields[0][0], da.Array) else np.stack
+    fields = [stack([field[i] for field in fields]) for i in range(len(fields[0]))]
+    data = _summarise_numpy(template, fields, n_batch_dims=1)
+    time_coord = _iris_time(first[0]["time"])
+    for i, member in enumerate(batch):
+        member_data = {name: values[i] for name, values in data.items()}
+        results[member] = _fill_templates(template, member_data, time_coord)
+    return results
+
+
+def _same_attrs(a, b):
+    return a.keys() == b.keys() and all(np.array_equal(a[k], b[k]) for k in a)
+
+
+def _check_fused(fused, two_pass, rtol):
+    # Confirm that the fused products match the two-pass products,
+    # in their metadata as well as their values
+    for name in fused:
+        if fused[name].name != two_pass[name].name or not _same_attrs(
+            fused[name].attrs, two_pass[name].attrs
+        ):
+            raise ValueError(
+                "Fused "
+                + name
+                + " metadata differs from the two-pass result ("
+                + repr(fused[name].attrs)
+                + " != "
+                + repr(two_pass[name].attrs)
+                + ")"
+            )
+        # Masked or NaN cells must match, and are then left out
+        a = np.ma.masked_invalid(fused[name].values)
+        b = np.ma.masked_invalid(two_pass[name].values)
+        if a.shape != b.shape or not np.array_equal(
+            np.ma.getmaskarray(a), np.ma.getmaskarray(b)
+        ):
+            raise ValueError(
+                "Fused "
+                + name
+                + " differs from the two-pass result in its shape or masked cells"
+            )
+        a = a.filled(np.nan)
+        b = b.filled(np.nan)
+        if not np.allclose(a, b, rtol=rtol, atol=0, equal_nan=True):
+            max_diff = np.nanmax(np.abs(a - b))
+            raise ValueError(
+                "Fused "
+                + name
+                + " differs from the two-pass result (max abs difference "
+                + str(max_diff)
+                + ")"
+            )
+
+
+def _compute_context(options):
+    # Compute lazily loaded chunks one at a time so that
+    # memory use stays within the --max-memory ceiling
+    if options["max_memory"] is not None:
+        return dask.config.set(scheduler="synchronous")
+    return contextlib.nullcontext()
+
+
+def _write_unit(init_year, member, products, output_dirs, options):
+    fn = _get_output_filename(init_year, member)
+    for name, product in products.items():
+        # Convert m/s to mm/s
+        product *= 1000.0
+        product.name = name
+        if options["output_layout"] in ["files", "both"]:
+            with _profile_stage("write"):
+                _write_product(
+                    product,
+                    os.path.join(output_dirs[name], fn),
+                    _get_encoding_policy(options),
+                )
+    return fn, products
+
+
+def _compute_unit(ncar_path, init_year, member, target, options, file_index=None):
+    # Regrid and summarise the CESM-DPLE precipitation
+    # for a single (init_year, member) unit
+    args = (ncar_path, init_year, member, target, options, file_index)
+    with _compute_context(options):
+        if options["engine"] == "numpy":
+            products = _compute_numpy(*args, fuse=options["fuse_precip"])
+            if options["check_fused"]:
+                two_pass = _compute_numpy(*args, fuse=False)
+                _check_fused(products, two_pass, options["check_rtol"])
+        elif options["fuse_precip"]:
+            products = _compute_fused(*args)
+            if options["check_fused"]:
+                two_pass = _compute_two_pass(*args)
+                _check_fused(products, two_pass, options["check_rtol"])
+        else:
+            products = _compute_two_pass(*args)
+    return products
+
+
+def _process_unit(
+    ncar_path, init_year, member, target, output_dirs, options, file_index=None
+):
+    products = _compute_unit(ncar_path, init_year, member, target, options, file_index)
+    return _write_unit(init_year, member, products, output_dirs, options)
+
+
+def _compute_members(ncar_path, init_year, members, target, options, file_index=None):
+    # Regrid and summarise several members of one initialization year
+    # together (numpy engine only), returning the products or the
+    # error of each member
+    args = (ncar_path, init_year, members, target, options, file_index)
+    with _compute_context(options):
+        results = _compute_numpy_batch(*args, fuse=options["fuse_precip"])
+        if not options["check_fused"]:
+            return results
+        two_pass = _compute_numpy_batch(*args, fuse=False)
+    for member, products in results.items():
+        if isinstance(products, Exception):
+            continue
+        try:
+            if isinstance(two_pass[member], Exception):
+                raise two_pass[member]
+            _check_fused(products, two_pass[member], options["check_rtol"])
+        except Exception as e:
+            results[member] = e
+    return results
+
+
+# Options that do not change the outputs, and so are
+# left out of the manifest code/config version
+UNVERSIONED_OPTIONS = [
+    "regrid_cache_dir",
+    "check_fused",
+    "check_rtol",
+    "output_layout",
+    "max_memory",
+    "profile",
+    "cprofile_units",
+    "cprofile_dir",
+    "batch_members",
+    "prefetch",
+]
+
+# Number of completed units between manifest saves
+MANIFEST_SAVE_EVERY = 10
+
+
+def _file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _file_record(path, hash_file=False):
+    stat = os.stat(path)
+    record = {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if hash_file:
+        record["sha1"] = _file_hash(path)
+    return record
+
+
+def _code_version(options, target_filename):
+    # Version of the code and settings that produced an output: any
+    # change to this script, the output-affecting options or the
+    # target grid file makes every existing output stale
+    h = hashlib.sha1()
+    with open(os.path.abspath(__file__), "rb") as f:
+        h.update(f.read())
+    settings = {k: v for k, v in options.items() if k not in UNVERSIONED_OPTIONS}
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    target = _file_record(target_filename)
+    h.update(json.dumps([target["size"], target["mtime_ns"]]).encode())
+    return h.hexdigest()
+
+
+def _unit_key(unit):
+    init_year, member = unit
+    return str(init_year) + "-" + str(member)
+
+
+def _manifest_record(file_index, output_dirs, fn, products, output_layout):
+    # Inputs (with content hashes) and per-file outputs of a completed
+    # unit, with the unencoded size of each product; store outputs are
+    # added as they are written by the parent. The inputs are hashed by
+    # the worker straight after processing, while they are still cached
+    inputs = {}
+    for (variable, _, _), filenames in file_index.items():
+        inputs[variable] = _file_record(filenames[0], hash_file=True)
+    outputs = {}
+    if output_layout in ["files", "both"]:
+        for name, outdir in output_dirs.items():
+            outputs[name] = _file_record(os.path.join(outdir, fn))
+            outputs[name]["nbytes"] = products[name].nbytes
+    return {"inputs": inputs, "outputs": outputs}
+
+
+def _load_manifest(manifest_fn):
+    if os.path.exists(manifest_fn):
+        with open(manifest_fn, "r") as f:
+            return json.load(f)
+    return {"units": {}}
+
+
+def _save_manifest(manifest, manifest_fn):
+    # Write to a temporary file first so that an interrupted
+    # save never leaves a truncated manifest behind
+    tmp_fn = manifest_fn + ".tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_fn, manifest_fn)
+
+
+def _input_is_current(record, path):
+    if record["path"] != path or not os.path.exists(path):
+        return False
+    current = _file_record(path)
+    if current["size"] != record["size"]:
+        return False
+    if current["mtime_ns"] == record["mtime_ns"]:
+        return True
+    # Only touched files are rehashed; if the content is unchanged the
+    # new mtime is recorded so the file is not rehashed next time
+    if "sha1" not in record or _file_hash(path) != record["sha1"]:
+        return False
+    record["mtime_ns"] = current["mtime_ns"]
+    return True
+
+
+def _output_is_current(record, store_units):
+    if "init_year" in record:
+        # Store slots are current if they have been written
+        unit = (record["init_year"], record["member"])
+        return unit in store_units.get(record["path"], set())
+    if not os.path.exists(record["path"]):
+        return False
+    current = _file_record(record["path"])
+    return (
+        current["size"] == record["size"] and current["mtime_ns"] == record["mtime_ns"]
+    )
+
+
+def _required_outputs(names, output_layout):
+    # Manifest output keys that a run with the given layout must have
+    # written for a unit to be up to date
+    keys = []
+    if output_layout in ["files", "both"]:
+        keys += names
+    if output_layout in ["store", "both"]:
+        keys += [name + "_store" for name in names]
+    return keys
+
+
+def _unit_is_current(
+    entry, version, unit_file_index, store_units, names, output_layout
+):
+    # A unit is current if it was produced by the same code version from
+    # unchanged inputs and every output the requested layout needs has
+    # been written and not modified since
+    if entry is None or entry["version"] != version:
+        return False
+    for (variable, _, _), filenames in unit_file_index.items():
+        if variable not in entry["inputs"]:
+            return False
+        if not _input_is_current(entry["inputs"][variable], filenames[0]):
+            return False
+    for key in _required_outputs(names, output_layout):
+        if key not in entry["outputs"]:
+            return False
+        if not _output_is_current(entry["outputs"][key], store_units):
+            return False
+    return True
+
+
+def _shard_suffix(shard=None):
+    # Suffix of the store and manifest filenames of shard (i, N)
+    if shard is None:
+        return ""
+    return ".shard-" + str(shard[0]) + "-of-" + str(shard[1])
+
+
+def _get_store_filename(output_dir, name, shard=None):
+    return os.path.join(
+        output_dir, "recipe1/store", name + _shard_suffix(shard) + ".nc"
+    )
+
+
+def _get_manifest_filename(output_dir, manifest_fn=None, shard=None):
+    if manifest_fn is None:
+        manifest_fn = os.path.join(output_dir, "recipe1/work/ncar_manifest.json")
+    root, ext = os.path.splitext(manifest_fn)
+    return root + _shard_suffix(shard) + ext
+
+
+def _create_store(store_fn, name, product, init_years, members, policy):
+    # One chunked NetCDF4 file per product, with explicit init_year and
+    # member dimensions; "time" becomes a lead_month dimension since the
+    # valid times differ between initialization years
+    time_units, calendar = xarray.coding.times.encode_cf_datetime(
+        product["time"].values
+    )[1:]
+    other_dims = [dim for dim in product.dims if dim != "time"]
+    os.makedirs(os.path.dirname(store_fn), exist_ok=True)
+    tmp_fn = store_fn + ".tmp"
+    nc = netCDF4.Dataset(tmp_fn, "w", format="NETCDF4")
+    nc.encoding_policy = json.dumps(policy, sort_keys=True)
+    nc.createDimension("init_year", len(init_years))
+    nc.createDimension("member", len(members))
+    nc.createDimension("lead_month", product.sizes["time"])
+    for dim in other_dims:
+        nc.createDimension(dim, product.sizes[dim])
+    nc.createVariable("init_year", "i4", ("init_year",))[:] = init_years
+    nc.createVariable("member", "i4", ("member",))[:] = members
+    lead_month = nc.createVariable("lead_month", "i4", ("lead_month",))
+    lead_month[:] = np.arange(product.sizes["time"])
+    lead_month.long_name = "months since the start of the hindcast"
+    time = nc.createVariable(
+        "time", "f8", ("init_year", "lead_month"), fill_value=np.nan
+    )
+    time.units = time_units
+    time.calendar = calendar
+    for dim in other_dims:
+        coord = nc.createVariable(dim, "f8", (dim,))
+        coord[:] = product[dim].values
+        coord.setncatts(product[dim].attrs)
+    scalar_coords = []
+    for coord_name, coord in product.coords.items():
+        if coord.ndim == 0:
+            nc.createVariable(coord_name, "f8", ())[...] = coord.values
+            nc[coord_name].setncatts(coord.attrs)
+            scalar_coords.append(coord_name)
+    dims = ("init_year", "member", "lead_month") + tuple(other_dims)
+    dtype = np.dtype(policy.get("dtype", product.dtype))
+    chunks = [product.sizes["time"]] + [product.sizes[d] for d in other_dims]
+    if "chunking" in policy:
+        chunks = _encoding_chunks(chunks, policy["chunking"], dtype.itemsize)
+    var = nc.createVariable(
+        name,
+        dtype,
+        dims,
+        chunksizes=(1, 1) + tuple(chunks),
+        fill_value=np.nan,
+        zlib=policy.get("zlib", False),
+        complevel=policy.get("complevel", 4),
+        shuffle=policy.get("shuffle", True),
+        significant_digits=policy.get("significant_digits"),
+    )
+    var.setncatts(product.attrs)
+    if len(scalar_coords) > 0:
+        var.coordinates = " ".join(scalar_coords)
+    complete = nc.createVariable("complete", "i1", ("init_year", "member"))
+    complete[:] = 0
+    complete.long_name = "whether the (init_year, member) unit has been written"
+    nc.close()
+    os.replace(tmp_fn, store_fn)
+
+
+def _store_policy(store_fn):
+    with netCDF4.Dataset(store_fn, "r") as nc:
+        return json.loads(getattr(nc, "encoding_policy", "{}"))
+
+
+def _append_to_store(
+    stores, store_fns, name, product, unit, init_years, members, policy
+):
+    # Write one unit into its slot of the product store, creating the
+    # store from the first unit written. A store written with another
+    # encoding policy is replaced, since all of its units are then stale.
+    # The store is written through netCDF4 directly, so xarray's HDF5 lock
+    # is held to keep out the --prefetch reader and writer threads
+    values = product.transpose("time", ...).values
+    with HDF5_LOCK:
+        if name not in stores:
+            store_fn = store_fns[name]
+            if os.path.exists(store_fn) and _store_policy(store_fn) != policy:
+                os.remove(store_fn)
+            if not os.path.exists(store_fn):
+                _create_store(store_fn, name, product, init_years, members, policy)
+            stores[name] = netCDF4.Dataset(store_fn, "a")
+        nc = stores[name]
+        init_year, member = unit
+        i = init_years.index(init_year)
+        j = members.index(member)
+        if product.sizes["time"] != nc.dimensions["lead_month"].size:
+            raise ValueError(
+                name
+                + " has "
+                + str(product.sizes["time"])
+                + " time steps, store has "
+                + str(nc.dimensions["lead_month"].size)
+            )
+        times = xarray.coding.times.encode_cf_datetime(
+            product["time"].values, nc["time"].units, nc["time"].calendar
+        )[0]
+        nc["time"][i, :] = times
+        nc[name][i, j, ...] = values
+        nc["complete"][i, j] = 1
+    return {
+        "path": store_fns[name],
+        "init_year": init_year,
+        "member": member,
+        "nbytes": product.nbytes,
+    }
+
+
+def _close_stores(stores):
+    with HDF5_LOCK:
+        for nc in stores.values():
+            nc.close()
+    stores.clear()
+
+
+def _store_units(store_fn):
+    # Units that have been written to a store
+    if not os.path.exists(store_fn):
+        return set()
+    with netCDF4.Dataset(store_fn, "r") as nc:
+        complete = nc["complete"][:]
+        init_years = nc["init_year"][:]
+        members = nc["member"][:]
+    i, j = np.nonzero(complete)
+    return set(zip(init_years[i].tolist(), members[j].tolist()))
+
+
+def _merge_store(shard_fn, store_fn, name):
+    # Copy the units written to a shard store into the merged store,
+    # re-encoding the times since each store has its own time units
+    if not os.path.exists(store_fn):
+        shutil.copyfile(shard_fn, store_fn)
+        return
+    with netCDF4.Dataset(shard_fn, "r") as src, netCDF4.Dataset(store_fn, "a") as dst:
+        if _store_policy(shard_fn) != _store_policy(store_fn):
+            raise ValueError(
+                shard_fn + " and " + store_fn + " have different encoding policies"
+            )
+        time_units = src["time"].units
+        calendar = src["time"].calendar
+        src.set_auto_mask(False)
+        complete = src["complete"][:]
+        for i, j in zip(*np.nonzero(complete)):
+            times = xarray.coding.times.decode_cf_datetime(
+                src["time"][i, :], time_units, calendar
+            )
+            dst["time"][i, :] = xarray.coding.times.encode_cf_datetime(
+                times, dst["time"].units, dst["time"].calendar
+            )[0]
+            dst[name][i, j, ...] = src[name][i, j, ...]
+            dst["complete"][i, j] = 1
+
+
+def _merge_shards(n_shards, output_dir, store_fns, manifest_fn):
+    # Merge the stores and manifests written by shards 0..N-1
+    # into the unsharded store and manifest
+    manifest = _load_manifest(manifest_fn)
+    for i in range(n_shards):
+        shard = (i, n_shards)
+        shard_manifest_fn = _get_manifest_filename(output_dir, manifest_fn, shard)
+        if not os.path.exists(shard_manifest_fn):
+            click.echo("No manifest for shard " + str(i), err=True)
+            continue
+        for key, entry in _load_manifest(shard_manifest_fn)["units"].items():
+            for record in entry["outputs"].values():
+                if "init_year" in record:
+                    name = os.path.basename(record["path"]).split(".")[0]
+                    record["path"] = store_fns[name]
+            manifest["units"][key] = entry
+        for name, store_fn in store_fns.items():
+            shard_fn = _get_store_filename(output_dir, name, shard)
+            if os.path.exists(shard_fn):
+                _merge_store(shard_fn, store_fn, name)
+    _save_manifest(manifest, manifest_fn)
+    return manifest
+
+
+def _export_store(store_fn, name, outdir, policy):
+    # Export a product store to the one-file-per-unit layout
+    # expected by ESMValTool-style consumers
+    os.makedirs(outdir, exist_ok=True)
+    ds = xarray.open_dataset(store_fn)
+    complete = ds["complete"].values
+    n = 0
+    for i, init_year in enumerate(ds["init_year"].values):
+        for j, member in enumerate(ds["member"].values):
+            if not complete[i, j]:
+                continue
+            product = ds[name].isel(init_year=i, member=j, drop=True)
+            product = product.rename(lead_month="time")
+            product = product.assign_coords(
+                time=ds["time"].isel(init_year=i, drop=True).values
+            )
+            product = product.drop_vars("lead_month", errors="ignore")
+            fn = _get_output_filename(int(init_year), int(member))
+            _write_product(product, os.path.join(outdir, fn), policy)
+            n += 1
+    ds.close()
+    return n
+
+
+# Target cube for each worker process, loaded once by `_init_worker`
+_WORKER_TARGET = None
+
+
+def _load_target(target_filename):
+    return iris.load_cube(target_filename, "slp")
+
+
+def _init_worker(target_filename):
+    global _WORKER_TARGET
+    _WORKER_TARGET = _load_target(target_filename)
+
+
+def _compute_units(units, ncar_path, target, options, file_index=None):
+    # Products, or the error, of each member of a batch of units
+    init_year = units[0][0]
+    members = [member for _, member in units]
+    try:
+        if len(units) == 1:
+            products = _compute_unit(
+                ncar_path, init_year, members[0], target, options, file_index
+            )
+            return {members[0]: products}
+        return _compute_members(
+            ncar_path, init_year, members, target, options, file_index
+        )
+    except Exception as e:
+        return {member: e for member in members}
+
+
+def _compute_batch(units, ncar_path, options, file_index=None, target=None):
+    # Compute a batch of units, under cProfile if requested for any of them
+    if target is None:
+        target = _WORKER_TARGET
+    keys = [_unit_key(unit) for unit in units]
+    if not any(key in options["cprofile_units"] for key in keys):
+        return _compute_units(units, ncar_path, target, options, file_index)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return _compute_units(units, ncar_path, target, options, file_index)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(
+            os.path.join(options["cprofile_dir"], "ncar_" + keys[0] + ".prof")
+        )
+
+
+def _finish_batch(units, results, output_dirs, options, file_index, profile=None):
+    # Write the products of a computed batch, capturing any error per unit
+    # so that a single missing or corrupt file does not abort the whole
+    # run. Returns (unit, error message, manifest record, products,
+    # profile) for each unit; stages shared by the units of a batch are
+    # recorded against the first
+    unit_results = []
+    for unit in units:
+        result = results[unit[1]]
+        unit_profile = profile if unit == units[0] else None
+        try:
+            if isinstance(result, Exception):
+                raise result
+            fn, products = _write_unit(*unit, result, output_dirs, options)
+            record = _manifest_record(
+                _unit_file_index(file_index, unit, NCAR_VARIABLES),
+                output_dirs,
+                fn,
+                products,
+                options["output_layout"],
+            )
+        except Exception as e:
+            msg = type(e).__name__ + ": " + str(e)
+            unit_results.append((unit, msg, None, None, unit_profile))
+            continue
+        # Products are only sent back to the parent if it writes them to a store
+        if options["output_layout"] == "files":
+            products = None
+        unit_results.append((unit, None, record, products, unit_profile))
+    return unit_results
+
+
+def _run_batch(units, ncar_path, output_dirs, options, file_index=None, target=None):
+    # Process a batch of units of one initialization year (a single unit
+    # unless --batch-members is set)
+    profile = {} if options["profile"] else None
+    with _profiling(profile), _profile_stage("unit"):
+        results = _compute_batch(units, ncar_path, options, file_index, target)
+        return _finish_batch(units, results, output_dirs, options, file_index, profile)
+
+
+def _prefetch_sources(ncar_path, units, options, file_index):
+    # Read the inputs of a batch into memory on the reader thread; inputs
+    # that cannot be read are left to fail when the unit is processed.
+    # Returns the sources and the usage of the read, if profiling
+    profile = {} if options["profile"] else None
+    sources = {}
+    with _profiling(profile), _profile_stage("prefetch"):
+        for init_year, member in units:
+            for variable in NCAR_VARIABLES:
+                try:
+                    source_fn = _get_filename(
+                        ncar_path, init_year, member, variable, file_index
+                    )
+                    sources[source_fn, variable] = _read_source(source_fn, variable)
+                except Exception:
+                    continue
+    return sources, profile
+
+
+def _finish_async(units, results, output_dirs, options, file_index, profile):
+    # _finish_batch on the writer thread, recording into the batch profile
+    with _profiling(profile):
+        return _finish_batch(units, results, output_dirs, options, file_index, profile)
+
+
+def _run_pipelined(batches, ncar_path, output_dirs, options, file_index, target):
+    # Process batches in this process with a reader thread that reads the
+    # inputs of up to --prefetch batches ahead, and a writer thread that
+    # writes up to --prefetch computed batches behind, so that NetCDF
+    # reads and writes overlap with compute while memory stays bounded
+    depth = options["prefetch"]
+    batch_indexes = [
+        _batch_file_index(file_index, batch, NCAR_VARIABLES) for batch in batches
+    ]
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(
+        max_workers=1
+    ) as writer:
+        reads = collections.deque()
+        writes = collections.deque()
+        for i, batch in enumerate(batches):
+            # Queue the current batch and the `depth` batches after it
+            while len(reads) < depth + 1 and i + len(reads) < len(batches):
+                j = i + len(reads)
+                reads.append(
+                    reader.submit(
+                        _prefetch_sources,
+                        ncar_path,
+                        batches[j],
+                        options,
+                        batch_indexes[j],
+                    )
+                )
+            sources, profile = reads.popleft().result()
+            _PREFETCHED.update(sources)
+            try:
+                with _profiling(profile), _profile_stage("unit"):
+                    results = _compute_batch(
+                        batch, ncar_path, options, batch_indexes[i], target
+                    )
+            finally:
+                _PREFETCHED.clear()
+            writes.append(
+                writer.submit(
+                    _finish_async,
+                    batch,
+                    results,
+                    output_dirs,
+                    options,
+                    batch_indexes[i],
+                    profile,
+                )
+            )
+            while len(writes) > depth or (len(writes) > 0 and writes[0].done()):
+                yield from writes.popleft().result()
+        while len(writes) > 0:
+            yield from writes.popleft().result()
+
+
+def _batch_units(units, batch_members):
+    # Group units of the same initialization year into
+    # batches of up to `batch_members` members
+    by_year = {}
+    for unit in units:
+        by_year.setdefault(unit[0], []).append(unit)
+    batches = []
+    for year_units in by_year.values():
+        for i in range(0, len(year_units), batch_members):
+            batches.append(year_units[i : i + batch_members])
+    return batches
+
+
+def _parse_shard(shard):
+    # (i, N) from --shard "i/N", or from the SLURM array task
+    # environment for --shard slurm; None if not sharded
+    if shard is None:
+        return None
+    if shard == "slurm":
+        try:
+            i = int(os.environ["SLURM_ARRAY_TASK_ID"]) - int(
+                os.environ.get("SLURM_ARRAY_TASK_MIN", 0)
+            )
+            n = int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+        except KeyError as e:
+            raise click.BadParameter(
+                str(e) + " is not set; is this a SLURM array job?",
+                param_hint="--shard",
+            )
+    else:
+        match = re.match(r"^(\d+)/(\d+)$", shard)
+        if match is None:
+            raise click.BadParameter("expected i/N or slurm", param_hint="--shard")
+        i, n = int(match.group(1)), int(match.group(2))
+    if not 0 <= i < n:
+        raise click.BadParameter(
+            "shard index must be in 0.." + str(n - 1), param_hint="--shard"
+        )
+    return i, n
+
+
+def _shard_units(units, shard, batch_members=1):
+    # Units of shard (i, N): batches (single units unless --batch-members
+    # is set) are dealt round-robin, so that shards get balanced numbers
+    # of units and every initialization year is spread over the shards
+    i, n = shard
+    batches = _batch_units(units, batch_members)
+    return [unit for batch in batches[i::n] for unit in batch]
+
+
+def _batch_file_index(file_index, batch, variables):
+    batch_index = {}
+    for unit in batch:
+        batch_index.update(_unit_file_index(file_index, unit, variables))
+    return batch_index
+
+
+def _run_units(
+    units, ncar_path, output_dirs, options, file_index, target_filename, workers
+):
+    # Yield (unit, error message, manifest record, products, profile)
+    # as units complete
+    batches = _batch_units(units, options["batch_members"])
+    if workers == 1 and options["prefetch"] > 0:
+        target = _load_target(target_filename)
+        yield from _run_pipelined(
+            batches, ncar_path, output_dirs, options, file_index, target
+        )
+        return
+    if workers == 1:
+        target = _load_target(target_filename)
+        for batch in batches:
+            batch_index = _batch_file_index(file_index, batch, NCAR_VARIABLES)
+            yield from _run_batch(
+                batch, ncar_path, output_dirs, options, batch_index, target
+            )
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(target_filename,),
+    ) as executor:
+        futures = [
+            executor.submit(
+                _run_batch,
+                batch,
+                ncar_path,
+                output_dirs,
+                options,
+                _batch_file_index(file_index, batch, NCAR_VARIABLES),
+            )
+            for batch in batches
+        ]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def _unit_file_index(file_index, unit, variables):
+    # The part of the file index needed by a single unit, so that
+    # workers are not sent the whole index with every task
+    init_year, member = unit
+    keys = [(variable, init_year, member) for variable in variables]
+    return {key: file_index.get(key, []) for key in keys}
+
+
+def _report_encoding(manifest, store_fns):
+    # Bytes written for each product against its unencoded size, over
+    # every unit recorded in the manifest; the saving is only given where
+    # the data is large enough for the file overhead not to dominate it
+    for name, store_fn in store_fns.items():
+        for key in [name, name + "_store"]:
+            records = [
+                entry["outputs"][key]
+                for entry in manifest["units"].values()
+                if "nbytes" in entry["outputs"].get(key, {})
+            ]
+            if len(records) == 0:
+                continue
+            nbytes = sum(record["nbytes"] for record in records)
+            if key == name:
+                written = sum(record["size"] for record in records)
+                n_files = len(records)
+            else:
+                written = os.path.getsize(store_fn)
+                n_files = 1
+            msg = (
+                key
+                + ": "
+                + "{:,}".format(written)
+                + " bytes written in "
+                + str(n_files)
+                + (" file" if n_files == 1 else " files")
+                + ", "
+                + "{:,}".format(nbytes)
+                + " bytes unencoded"
+            )
+            if nbytes >= n_files * NETCDF_FILE_OVERHEAD:
+                msg += " (" + "{:.0%}".format(1 - written / nbytes) + " saved)"
+            click.echo(msg)
+
+
+def _report_failures(failures, n_units, label="failed"):
+    # Summarise failed units
+    if len(failures) == 0:
+        return
+    click.echo(
+        str(len(failures)) + " of " + str(n_units) + " units " + label + ":", err=True
+    )
+    for (init_year, member), msg in sorted(failures.items()):
+        click.echo(
+            "  init_year=" + str(init_year) + " member=" + str(member) + ": " + msg,
+            err=True,
+        )
+
+
 @click.command()
 @click.option("--config", default="config.yml", help="YAML configuration file")
-def main(config):
+@click.option(
+    "--workers",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of worker processes over (init_year, member) units",
+)
+@click.option(
+    "--regrid-cache",
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Directory in which to save regridding weights for reuse by later runs",
+)
+@click.option(
+    "--fuse-precip/--no-fuse-precip",
+    default=False,
+    help="Sum PRECC and PRECL on the native grid and regrid the total once",
+)
+@click.option(
+    "--check-fused",
+    is_flag=True,
+    default=False,
+    help="Also run the two-pass computation and check that it matches the fused one",
+)
+@click.option(
+    "--check-rtol",
+    default=1e-5,
+    type=float,
+    help="Relative tolerance used by --check-fused",
+)
+@click.option(
+    "--file-index",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="JSON sidecar in which to save the index of input files",
+)
+@click.option(
+    "--manifest",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Manifest of outputs (default: recipe1/work/ncar_manifest.json)",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Skip units whose outputs are up to date according to the manifest",
+)
+@click.option(
+    "--output-layout",
+    default="files",
+    type=click.Choice(["files", "store", "both"]),
+    help="Write one file per unit, one chunked store per product, or both",
+)
+@click.option(
+    "--export-files",
+    is_flag=True,
+    default=False,
+    help="Export the product stores to the one-file-per-unit layout and exit",
+)
+@click.option(
+    "--max-memory",
+    default=None,
+    type=click.FloatRange(min=1),
+    help="Approximate memory ceiling per worker in MB; reads inputs lazily in time chunks",
+)
+@click.option(
+    "--encoding",
+    default="native",
+    type=click.Choice(list(ENCODING_POLICIES)),
+    help="Output encoding policy: as computed, or compressed float32",
+)
+@click.option(
+    "--chunking",
+    default="time",
+    type=click.Choice(["time", "map"]),
+    help="Chunk encoded outputs for time-series or for map access",
+)
+@click.option(
+    "--significant-digits",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Quantize outputs to this many significant digits (lossy)",
+)
+@click.option(
+    "--engine",
+    default="iris",
+    type=click.Choice(["iris", "numpy"]),
+    help="Compute with Iris cubes, or with NumPy arrays using Iris only for set-up",
+)
+@click.option(
+    "--profile",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write wall/CPU time, bytes read/written and peak RSS per stage and unit to this .json or .csv file",
+)
+@click.option(
+    "--cprofile",
+    multiple=True,
+    help="Run cProfile on this INIT_YEAR-MEMBER unit (repeatable); stats are saved beside the --profile file",
+)
+@click.option(
+    "--batch-members",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Regrid up to this many members of an init year in one stacked call (numpy engine)",
+)
+@click.option(
+    "--shard",
+    default=None,
+    help="Process shard i/N of the units (0 <= i < N), or 'slurm' to take it from the SLURM array task",
+)
+@click.option(
+    "--merge-shards",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Merge the stores and manifests of N shards, verify that every unit is complete, and exit",
+)
+@click.option(
+    "--prefetch",
+    default=0,
+    type=click.IntRange(min=0),
+    help="Read the inputs of up to N batches ahead on a reader thread and write outputs on a writer thread, overlapping NetCDF I/O with compute (--workers 1 only)",
+)
+def main(
+    config,
+    workers,
+    regrid_cache,
+    fuse_precip,
+    check_fused,
+    check_rtol,
+    file_index,
+    manifest,
+    incremental,
+    output_layout,
+    export_files,
+    max_memory,
+    encoding,
+    chunking,
+    significant_digits,
+    engine,
+    profile,
+    cprofile,
+    batch_members,
+    shard,
+    merge_shards,
+    prefetch,
+):
     # config = "test-config.yml"  # LOCAL TESTING ONLY - REMOVE
     # config = "~/decadal-flood-prediction/arc-config.yml"
     with open(config, "r") as f:
@@ -241,107 +2200,166 @@ def main(config):
     hadslp2r_filename = os.path.join(
         config["observed_data"]["hadslp2r"], "slp.mnmean.real.nc"
     )
-    target = iris.load_cube(hadslp2r_filename, "slp")
 
     # Create output directories
-    european_precip_outdir = os.path.join(
-        output_dir,
-        "recipe1/work/european_precip/european_precip"
-    )
-    uk_precip_outdir = os.path.join(
-        output_dir,
-        "recipe1/work/uk_precip/uk_precip"
-    )
-    # uk_precip_field_outdir = os.path.join(
-    #     output_dir,
-    #     "recipe1/work/uk_precip_field/uk_precip_field"
-    # )
-    precip_field_outdir = os.path.join(
-        output_dir,
-        "recipe1/work/precip_field/precip_field"
-    )
-    os.makedirs(european_precip_outdir, exist_ok=True)
-    os.makedirs(uk_precip_outdir, exist_ok=True)
-    os.makedirs(precip_field_outdir, exist_ok=True)
-    # os.makedirs(uk_precip_field_outdir, exist_ok=True)
+    output_dirs = _get_output_dirs(output_dir)
+    for outdir in output_dirs.values():
+        os.makedirs(outdir, exist_ok=True)
+    shard = _parse_shard(shard)
+    store_fns = {
+        name: _get_store_filename(output_dir, name, shard) for name in output_dirs
+    }
+
+    options = {
+        "regrid_cache_dir": regrid_cache,
+        "fuse_precip": fuse_precip or check_fused,
+        "check_fused": check_fused,
+        "check_rtol": check_rtol,
+        "output_layout": output_layout,
+        "max_memory": max_memory,
+        "encoding": encoding,
+        "chunking": chunking,
+        "significant_digits": significant_digits,
+        "engine": engine,
+        "profile": profile is not None,
+        "cprofile_units": list(cprofile),
+        "cprofile_dir": os.path.dirname(os.path.abspath(profile or "ncar_profile")),
+        "batch_members": batch_members,
+        "prefetch": prefetch,
+    }
+    if batch_members > 1 and engine != "numpy":
+        raise click.UsageError("--batch-members requires --engine numpy")
+    if prefetch > 0 and workers > 1:
+        raise click.UsageError("--prefetch requires --workers 1")
+    if prefetch > 0 and max_memory is not None:
+        raise click.UsageError(
+            "--prefetch reads whole files, so cannot be used with --max-memory"
+        )
+    policy = _get_encoding_policy(options)
+    if profile is not None or len(cprofile) > 0:
+        os.makedirs(options["cprofile_dir"], exist_ok=True)
+
+    if export_files:
+        for name, store_fn in store_fns.items():
+            n = _export_store(store_fn, name, output_dirs[name], policy)
+            click.echo("Exported " + str(n) + " " + name + " files")
+        return
 
     init_years = [i for i in range(1960, 2015)]
     members = [i for i in range(1, 41)]
-    variables = ["PRECC", "PRECL"]
-    for i in tqdm(range(len(init_years))):
-        init_year = init_years[i]
-        for j in range(len(members)):
-            member = members[j]
-            european_precip_dict = {}
-            uk_precip_dict = {}
-            # uk_precip_field_dict = {}
-            precip_field_dict = {}
-
-            for k in range(len(variables)):
-                variable = variables[k]
-                source_fn = _get_filename(ncar_path, init_year, member, variable)
-                # source_fn = 'data-raw/ncar_prec_data/b.e11.BDP.f09_g16.1983-11.001.cam.h0.PRECC.198311-199312.nc'
-                xr_source = xarray.open_dataset(source_fn)[variable]
-                source = xr_source.to_iris()
-                ds = _regrid_cube(source, target)
-                # iris.coord_categorisation.add_season(
-                #     # ds, "time", seasons=["djfm", "am", "jjas", "on"]
-                #     ds, "time", seasons=["sondjfm", "amjja"]
-                # )
-                # iris.coord_categorisation.add_season_year(
-                #     # ds, "time", seasons=["djfm", "am", "jjas", "on"]
-                #     ds, "time", seasons=["sondjfm", "amjja"]
-                # )
-                # ds = ds.extract(iris.Constraint(season="sondjfm"))
-
-                # European precip
-                european_precip = _extract_european_precip_ts(ds)
-                european_precip = xarray.DataArray.from_iris(european_precip)
-                european_precip.name = "european_precip"
-                european_precip_dict[variable] = european_precip
-
-                # UK precip
-                uk_precip = _extract_uk_precip_ts(ds)
-                uk_precip = xarray.DataArray.from_iris(uk_precip)
-                uk_precip.name = "uk_precip"
-                uk_precip_dict[variable] = uk_precip
-
-                # # UK precip field
-                # uk_precip_field = _extract_uk_precip_field(ds)
-                # uk_precip_field = xarray.DataArray.from_iris(uk_precip_field)
-                # uk_precip_field.name = "uk_precip_field"
-                # uk_precip_field_dict[variable] = uk_precip_field
-
-                # Global precip field
-                precip_field = _extract_precip_field(ds)
-                precip_field = xarray.DataArray.from_iris(precip_field)
-                precip_field.name = "precip_field"
-                precip_field_dict[variable] = precip_field
-
-            european_precip = (
-                european_precip_dict["PRECC"] + european_precip_dict["PRECL"]
-            )
-            uk_precip = (
-                uk_precip_dict["PRECC"] + uk_precip_dict["PRECL"]
+    units = [(init_year, member) for init_year in init_years for member in members]
+    if shard is not None:
+        units = _shard_units(units, shard, batch_members)
+        click.echo(
+            "Shard "
+            + str(shard[0])
+            + " of "
+            + str(shard[1])
+            + ": "
+            + str(len(units))
+            + " units"
+        )
+
+    # Index the input files once and report problems up front
+    sidecar = file_index
+    file_index = _load_file_index(ncar_path, NCAR_VARIABLES, sidecar)
+    failures = _check_file_index(file_index, units, NCAR_VARIABLES)
+    _report_failures(failures, len(units), label="have missing or duplicate inputs")
+    pending = [unit for unit in units if unit not in failures]
+
+    # Only recompute stale or missing units in incremental mode
+    manifest_fn = _get_manifest_filename(output_dir, manifest, shard)
+    manifest = _load_manifest(manifest_fn)
+    version = _code_version(options, hadslp2r_filename)
+    if merge_shards is not None:
+        manifest = _merge_shards(merge_shards, output_dir, store_fns, manifest_fn)
+    if incremental or merge_shards is not None:
+        store_units = {fn: _store_units(fn) for fn in store_fns.values()}
+        current = [
+            unit
+            for unit in pending
+            if _unit_is_current(
+                manifest["units"].get(_unit_key(unit)),
+                version,
+                _unit_file_index(file_index, unit, NCAR_VARIABLES),
+                store_units,
+                list(output_dirs),
+                options["output_layout"],
             )
-            # uk_precip_field = (
-            #     uk_precip_field_dict['PRECC'] + uk_precip_field_dict['PRECL']
-            # )
-            precip_field = (
-                precip_field_dict['PRECC'] + precip_field_dict['PRECL']
+        ]
+        pending = [unit for unit in pending if unit not in current]
+    if merge_shards is not None:
+        # Verify that the shards between them produced every unit
+        _report_failures(
+            {unit: "missing or out of date" for unit in pending},
+            len(units),
+            label="are incomplete after merging",
+        )
+        if len(pending) > 0 or len(failures) > 0:
+            raise click.ClickException(
+                str(len(pending) + len(failures)) + " units are incomplete"
             )
-
-            # Convert m/s to mm/s
-            european_precip *= 1000.0
-            uk_precip *= 1000.0
-            # uk_precip_field *= 1000.0
-            precip_field *= 1000.0
-
-            fn = _get_output_filename(init_year, member)
-            european_precip.to_netcdf(os.path.join(european_precip_outdir, fn))
-            uk_precip.to_netcdf(os.path.join(uk_precip_outdir, fn))
-            precip_field.to_netcdf(os.path.join(precip_field_outdir, fn))
-            # uk_precip_field.to_netcdf(os.path.join(uk_precip_field_outdir, fn))
+        click.echo("Merged " + str(merge_shards) + " shards; all units complete")
+        return
+    if incremental:
+        click.echo(
+            str(len(units) - len(failures) - len(pending))
+            + " units up to date, "
+            + str(len(pending))
+            + " to process"
+        )
+
+    results = _run_units(
+        pending, ncar_path, output_dirs, options, file_index, hadslp2r_filename, workers
+    )
+    stores = {}
+    profile_rows = []
+    try:
+        for i, (unit, msg, record, products, unit_profile) in enumerate(
+            tqdm(results, total=len(pending))
+        ):
+            if msg is None and products is not None:
+                try:
+                    with _profiling(unit_profile), _profile_stage("store"):
+                        for name, product in products.items():
+                            record["outputs"][name + "_store"] = _append_to_store(
+                                stores,
+                                store_fns,
+                                name,
+                                product,
+                                unit,
+                                init_years,
+                                members,
+                                policy,
+                            )
+                except Exception as e:
+                    msg = type(e).__name__ + ": " + str(e)
+            if unit_profile is not None:
+                for stage, usage in unit_profile.items():
+                    profile_rows.append(
+                        dict(init_year=unit[0], member=unit[1], stage=stage, **usage)
+                    )
+            if msg is not None:
+                failures[unit] = msg
+                manifest["units"].pop(_unit_key(unit), None)
+            else:
+                record["version"] = version
+                manifest["units"][_unit_key(unit)] = record
+            if (i + 1) % MANIFEST_SAVE_EVERY == 0:
+                for nc in stores.values():
+                    nc.sync()
+                _save_manifest(manifest, manifest_fn)
+    finally:
+        _close_stores(stores)
+        _save_manifest(manifest, manifest_fn)
+
+    if len(policy) > 0:
+        _report_encoding(manifest, store_fns)
+    if profile is not None:
+        _write_profile(profile_rows, profile)
+    _report_failures(failures, len(units))
+    if len(failures) > 0:
+        raise click.ClickException(str(len(failures)) + " units failed")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+
+# Benchmark the stages of 03_process-ncar-prec-data.py on synthetic
+# CESM-DPLE PRECC/PRECL files (CAM f09 grid) and a HadSLP2r-like 5 degree
+# target grid, written to a temporary directory. Results are written as
+# JSON; with --baseline, stages whose median time exceeds the baseline by
+# more than --max-slowdown are reported and the script exits non-zero.
+#
+# e.g. python benchmarks/bench_ncar_prec.py --init-years 2 --members 2 \
+#          --output bench.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import platform
+import importlib.util
+
+import numpy as np
+import cftime
+import iris
+import xarray
+import click
+
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# CAM f09 (0.9 x 1.25 degree) grid used by CESM-DPLE
+CAM_F09_LAT = np.linspace(-90, 90, 192)
+CAM_F09_LON = np.arange(288) * 1.25
+
+# HadSLP2r 5 degree grid
+HADSLP_LAT = np.arange(90, -91, -5.0)
+HADSLP_LON = np.arange(0, 360, 5.0)
+
+FIRST_INIT_YEAR = 1960
+
+
+def _import_ncar():
+    # The script name is not a valid module name,
+    # so it is imported from its file location
+    spec = importlib.util.spec_from_file_location(
+        "process_ncar_prec_data",
+        os.path.join(ROOTDIR, "03_process-ncar-prec-data.py"),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _grid_coords(lat, lon):
+    return {
+        "lat": ("lat", lat, {"units": "degrees_north", "standard_name": "latitude"}),
+        "lon": ("lon", lon, {"units": "degrees_east", "standard_name": "longitude"}),
+    }
+
+
+def _write_ncar_data(ncar_path, variables, units, n_months, seed=0):
+    # One file per (variable, init_year, member), named as in the
+    # CESM-DPLE archive, starting in November of the initialization year
+    rng = np.random.default_rng(seed)
+    shape = (n_months, CAM_F09_LAT.size, CAM_F09_LON.size)
+    for variable in variables:
+        os.makedirs(os.path.join(ncar_path, variable), exist_ok=True)
+    for init_year, member in units:
+        months = [
+            (init_year + (10 + i) // 12, (10 + i) % 12 + 1) for i in range(n_months)
+        ]
+        times = [cftime.DatetimeNoLeap(year, month, 15) for year, month in months]
+        for variable in variables:
+            data = rng.gamma(0.5, 2e-8, size=shape).astype("float32")
+            coords = _grid_coords(CAM_F09_LAT, CAM_F09_LON)
+            coords["time"] = times
+            da = xarray.DataArray(
+                data,
+                dims=("time", "lat", "lon"),
+                coords=coords,
+                name=variable,
+                attrs={"units": "m/s", "long_name": variable + " precipitation rate"},
+            )
+            fn = "b.e11.BDP.f09_g16.%d-11.%03d.cam.h0.%s.%d11-%d%02d.nc" % (
+                (init_year, member, variable, init_year) + months[-1]
+            )
+            da.to_dataset().to_netcdf(os.path.join(ncar_path, variable, fn))
+
+
+def _write_target(target_path):
+    os.makedirs(target_path, exist_ok=True)
+    data = np.full((2, HADSLP_LAT.size, HADSLP_LON.size), 1013.0, dtype="float32")
+    coords = _grid_coords(HADSLP_LAT, HADSLP_LON)
+    coords["time"] = [cftime.DatetimeGregorian(1850, month, 1) for month in [1, 2]]
+    da = xarray.DataArray(
+        data,
+        dims=("time", "lat", "lon"),
+        coords=coords,
+        name="slp",
+        attrs={"units": "hPa"},
+    )
+    target_filename = os.path.join(target_path, "slp.mnmean.real.nc")
+    da.to_dataset().to_netcdf(target_filename)
+    return target_filename
+
+
+def _options(engine="iris", fuse_precip=False):
+    # Options as built by main() in the NCAR script
+    return {
+        "regrid_cache_dir": None,
+        "fuse_precip": fuse_precip,
+        "check_fused": False,
+        "check_rtol": 1e-5,
+        "output_layout": "files",
+        "max_memory": None,
+        "encoding": "native",
+        "chunking": "time",
+        "significant_digits": None,
+        "engine": engine,
+        "profile": False,
+        "cprofile_units": [],
+        "cprofile_dir": ".",
+        "batch_members": 1,
+        "prefetch": 0,
+    }
+
+
+def _timed(timings, stage, fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    timings.setdefault(stage, []).append(time.perf_counter() - t0)
+    return result
+
+
+def _load_realised(ncar, *args):
+    # Load a source cube including reading its data from disk
+    source = ncar._load_source(*args)
+    source.data
+    return source
+
+
+def _summarise(times):
+    return {
+        "runs": len(times),
+        "first": times[0],
+        "min": float(np.min(times)),
+        "median": float(np.median(times)),
+        "total": float(np.sum(times)),
+    }
+
+
+def _max_rel_diff(a, b):
+    # Largest difference relative to the largest value of `a`, or
+    # infinity if they differ in shape or in their masked (NaN) cells
+    a = np.asarray(a.values, dtype=np.float64)
+    b = np.asarray(b.values, dtype=np.float64)
+    if a.shape != b.shape or not np.array_equal(np.isnan(a), np.isnan(b)):
+        return float("inf")
+    if np.all(np.isnan(a)):
+        return 0.0
+    scale = np.nanmax(np.abs(a))
+    return float(np.nanmax(np.abs(a - b)) / scale) if scale > 0 else 0.0
+
+
+def _reference_regrid(ncar, source, target):
+    # Regrid with plain Iris, as the script did before
+    # its regridding weights were cached
+    source = source.copy()
+    for get_name in [ncar._get_longitude_name, ncar._get_latitude_name]:
+        coord = source.coord(get_name(source))
+        coord.rename(get_name(target))
+        coord.coord_system = target.coord(get_name(target)).coord_system
+    return source.regrid(target, iris.analysis.Linear())
+
+
+def _reference_ts(ncar, x, xmin, xmax, ymin, ymax):
+    # Area-weighted box mean with plain Iris, as the script
+    # did before its box weights were cached
+    x = x.copy()
+    lon_name = ncar._get_longitude_name(x)
+    lat_name = ncar._get_latitude_name(x)
+    for name in [lon_name, lat_name]:
+        if x.coord(name).bounds is None:
+            x.coord(name).guess_bounds()
+    positive_lon = ncar._has_positive_longitude(x)
+    xmin, xmax = ncar._transform_longitude(xmin, xmax, positive_lon)
+    box = x.intersection(longitude=(xmin, xmax), latitude=(ymin, ymax))
+    grid_areas = iris.analysis.cartography.area_weights(box)
+    return box.collapsed([lat_name, lon_name], iris.analysis.MEAN, weights=grid_areas)
+
+
+def _reference_products(ncar, sources, target):
+    # Two-pass products of PRECC and PRECL computed with plain Iris
+    products = {}
+    for source in sources:
+        ds = _reference_regrid(ncar, source, target)
+        cubes = {
+            name: _reference_ts(ncar, ds, *box) for name, box in ncar.BOXES.items()
+        }
+        cubes["precip_field"] = ds
+        for name, cube in cubes.items():
+            product = xarray.DataArray.from_iris(cube)
+            if name in products:
+                products[name] = products[name] + product
+            else:
+                products[name] = product
+    # Converted to mm/s and named as by _write_unit
+    for name, product in products.items():
+        product *= 1000.0
+        product.name = name
+    return products
+
+
+def _masked_box_diffs(ncar, ds):
+    # Box means of a regridded cube with scattered masked cells, and a
+    # first time step masked throughout, against plain Iris
+    masked = ds.copy()
+    mask = np.zeros(masked.shape, dtype=bool)
+    mask[..., ::3, ::2] = True
+    mask[0] = True
+    masked.data = np.ma.masked_where(mask, masked.data)
+    diffs = {}
+    for name, box in ncar.BOXES.items():
+        reference = xarray.DataArray.from_iris(_reference_ts(ncar, masked, *box))
+        ts = xarray.DataArray.from_iris(ncar._extract_ts(masked, *box))
+        diffs[name] = _max_rel_diff(reference, ts)
+    return diffs
+
+
+def _same_metadata(a, b):
+    return (
+        a.name == b.name
+        and a.attrs.keys() == b.attrs.keys()
+        and all(np.array_equal(a.attrs[k], b.attrs[k]) for k in a.attrs)
+    )
+
+
+def _run_stages(ncar, ncar_path, target_filename, outdir, units, repeat):
+    # Time each stage once per unit and repeat; the first run of a stage
+    # includes building the cached regridding and box weights
+    timings = {}
+    checks = {}
+    metadata = set()
+    target = ncar._load_target(target_filename)
+    file_index = _timed(
+        timings,
+        "_load_file_index",
+        ncar._load_file_index,
+        ncar_path,
+        ncar.NCAR_VARIABLES,
+    )
+    output_dirs = ncar._get_output_dirs(outdir)
+    for path in output_dirs.values():
+        os.makedirs(path, exist_ok=True)
+    for _ in range(repeat):
+        for init_year, member in units:
+            unit_index = ncar._unit_file_index(
+                file_index, (init_year, member), ncar.NCAR_VARIABLES
+            )
+            _timed(
+                timings,
+                "_get_filename (glob)",
+                ncar._get_filename,
+                ncar_path,
+                init_year,
+                member,
+                "PRECC",
+            )
+            _timed(
+                timings,
+                "_get_filename (index)",
+                ncar._get_filename,
+                ncar_path,
+                init_year,
+                member,
+                "PRECC",
+                unit_index,
+            )
+            source = _timed(
+                timings,
+                "_load_source",
+                _load_realised,
+                ncar,
+                ncar_path,
+                init_year,
+                member,
+                "PRECC",
+                unit_index,
+            )
+            ds = _timed(timings, "_regrid_cube", ncar._regrid_cube, source, target)
+            for name, diff in _masked_box_diffs(ncar, ds).items():
+                key = "_extract_ts (masked cells) " + name
+                checks[key] = max(checks.get(key, 0.0), diff)
+            _timed(
+                timings,
+                "_extract_european_precip_ts",
+                ncar._extract_european_precip_ts,
+                ds,
+            )
+            _timed(timings, "_extract_uk_precip_ts", ncar._extract_uk_precip_ts, ds)
+            field = xarray.DataArray.from_iris(ds)
+            _timed(
+                timings,
+                "to_netcdf",
+                field.to_netcdf,
+                os.path.join(outdir, "precip_field.nc"),
+            )
+
+            # Whole units with each engine, checked against
+            # products computed with plain Iris
+            sources = [
+                _load_realised(ncar, ncar_path, init_year, member, variable, unit_index)
+                for variable in ncar.NCAR_VARIABLES
+            ]
+            reference = _timed(
+                timings,
+                "Iris reference",
+                _reference_products,
+                ncar,
+                sources,
+                target,
+            )
+            products = {}
+            for engine in ["iris", "numpy"]:
+                for fuse_precip in [False, True]:
+                    stage = "_process_unit (" + engine
+                    stage += ", fused)" if fuse_precip else ", two-pass)"
+                    products[stage] = _timed(
+                        timings,
+                        stage,
+                        ncar._process_unit,
+                        ncar_path,
+                        init_year,
+                        member,
+                        target,
+                        output_dirs,
+                        _options(engine, fuse_precip),
+                        unit_index,
+                    )[1]
+            for stage, result in products.items():
+                for name, product in result.items():
+                    diff = _max_rel_diff(reference[name], product)
+                    key = stage + " " + name
+                    checks[key] = max(checks.get(key, 0.0), diff)
+                    if not _same_metadata(reference[name], product):
+                        metadata.add(key)
+    return timings, checks, sorted(metadata)
+
+
+def _check_prefetch(ncar, n_batches, depth, timeout=5.0):
+    # Run the --prefetch pipeline with stand-in reads, computes and
+    # writes, and return the batches whose computation started before
+    # the reads of the following `depth` batches had been started
+    started = [threading.Event() for _ in range(n_batches)]
+    late = []
+
+    def prefetch_sources(ncar_path, units, options, file_index):
+        started[units[0][1]].set()
+        return {}, None
+
+    def compute_batch(units, ncar_path, options, file_index=None, target=None):
+        i = units[0][1]
+        for j in range(i + 1, min(i + depth + 1, n_batches)):
+            if not started[j].wait(timeout):
+                late.append(i)
+                break
+        return {}
+
+    def finish_async(units, results, output_dirs, options, file_index, profile):
+        return []
+
+    options = _options()
+    options["prefetch"] = depth
+    batches = [[(FIRST_INIT_YEAR, i)] for i in range(n_batches)]
+    originals = (ncar._prefetch_sources, ncar._compute_batch, ncar._finish_async)
+    ncar._prefetch_sources = prefetch_sources
+    ncar._compute_batch = compute_batch
+    ncar._finish_async = finish_async
+    try:
+        list(ncar._run_pipelined(batches, None, {}, options, {}, None))
+    finally:
+        ncar._prefetch_sources, ncar._compute_batch, ncar._finish_async = originals
+    return late
+
+
+def _compare(results, baseline, max_slowdown):
+    # Stages whose median time exceeds the baseline median by more than
+    # `max_slowdown` times
+    slower = {}
+    for stage, summary in results["stages"].items():
+        if stage not in baseline["stages"]:
+            continue
+        ratio = summary["median"] / baseline["stages"][stage]["median"]
+        if ratio > max_slowdown:
+            slower[stage] = ratio
+    return slower
+
+
+@click.command()
+@click.option(
+    "--init-years",
+    default=2,
+    type=click.IntRange(min=1),
+    help="Number of initialization years",
+)
+@click.option(
+    "--members",
+    default=2,
+    type=click.IntRange(min=1),
+    help="Number of ensemble members",
+)
+@click.option(
+    "--months",
+    default=122,
+    type=click.IntRange(min=1),
+    help="Time steps per file (CESM-DPLE hindcasts have 122)",
+)
+@click.option(
+    "--repeat", default=1, type=click.IntRange(min=1), help="Passes over the units"
+)
+@click.option(
+    "--workdir",
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Directory for the synthetic data, kept between runs (default: temporary)",
+)
+@click.option(
+    "--output",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="JSON results file (default: stdout)",
+)
+@click.option(
+    "--baseline",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON results to compare against",
+)
+@click.option(
+    "--max-slowdown",
+    default=1.25,
+    type=float,
+    help="Median time ratio to the baseline above which a stage is reported",
+)
+@click.option(
+    "--check-rtol",
+    default=1e-5,
+    type=float,
+    help="Largest relative difference allowed from the products of plain Iris",
+)
+def main(
+    init_years,
+    members,
+    months,
+    repeat,
+    workdir,
+    output,
+    baseline,
+    max_slowdown,
+    check_rtol,
+):
+    ncar = _import_ncar()
+    units = [
+        (init_year, member)
+        for init_year in range(FIRST_INIT_YEAR, FIRST_INIT_YEAR + init_years)
+        for member in range(1, members + 1)
+    ]
+    tmpdir = None
+    if workdir is None:
+        workdir = tmpdir = tempfile.mkdtemp(prefix="bench_ncar_prec_")
+    try:
+        ncar_path = os.path.join(workdir, "ncar")
+        if not os.path.isdir(ncar_path):
+            t0 = time.perf_counter()
+            _write_ncar_data(ncar_path, ncar.NCAR_VARIABLES, units, months)
+            click.echo(
+                "Wrote synthetic data in %.1f s" % (time.perf_counter() - t0), err=True
+            )
+        target_filename = _write_target(os.path.join(workdir, "hadslp"))
+        timings, checks, metadata = _run_stages(
+            ncar,
+            ncar_path,
+            target_filename,
+            os.path.join(workdir, "output"),
+            units,
+            repeat,
+        )
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    results = {
+        "scale": {
+            "init_years": init_years,
+            "members": members,
+            "months": months,
+            "repeat": repeat,
+            "source_grid": [CAM_F09_LAT.size, CAM_F09_LON.size],
+            "target_grid": [HADSLP_LAT.size, HADSLP_LON.size],
+        },
+        "platform": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "numpy": np.__version__,
+            "xarray": xarray.__version__,
+            "iris": iris.__version__,
+        },
+        "stages": {stage: _summarise(times) for stage, times in timings.items()},
+        "checks": checks,
+        "metadata_mismatches": metadata,
+    }
+    text = json.dumps(results, indent=2)
+    if output is None:
+        click.echo(text)
+    else:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+
+    failed = False
+    for key, diff in sorted(checks.items()):
+        if diff > check_rtol:
+            click.echo("Check failed: " + key + " differs by " + str(diff), err=True)
+            failed = True
+    for key in metadata:
+        click.echo(
+            "Check failed: " + key + " metadata differs from the Iris reference",
+            err=True,
+        )
+        failed = True
+    for depth in [1, 2]:
+        late = _check_prefetch(ncar, 4, depth)
+        if len(late) > 0:
+            click.echo(
+                "Check failed: with --prefetch "
+                + str(depth)
+                + ", batches "
+                + str(late)
+                + " were computed before the next batches were read",
+                err=True,
+            )
+            failed = True
+    if baseline is not None:
+        with open(baseline, "r") as f:
+            slower = _compare(results, json.load(f), max_slowdown)
+        for stage, ratio in sorted(slower.items()):
+            click.echo("Slower than baseline: %s (%.2fx)" % (stage, ratio), err=True)
+        failed = failed or len(slower) > 0
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
+import os
 import logging
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import iris
 import xarray
@@ -9,27 +11,14 @@ import xarray
 from esmvaltool.diag_scripts.shared import (
     group_metadata,
     run_diagnostic,
-    # get_diagnostic_filename,
-    # ProvenanceLogger,
+    get_diagnostic_filename,
 )
 
 from utils import (
-    _extract_nao_ts,
-    _extract_ea_ts,
-    _extract_amv_ts,
-    _extract_european_precip_ts,
-    _extract_uk_precip_ts,
-    _extract_uk_temp_ts,
-    _extract_nino1_ts,
-    _extract_nino2_ts,
-    _extract_nino12_ts,
-    _extract_nino3_ts,
-    _extract_nino34_ts,
-    _extract_nino4_ts,
-    _extract_iod_ts,
-    _extract_pdv_ts,
-    _extract_ipo_ts,
-    _extract_sahel_precip_ts,
+    INDEX_TERMS,
+    ProvenanceCollector,
+    XarrayStore,
+    compute_indices,
     # _extract_uk_precip_field,
     _extract_precip_field,
     _extract_temp_field,
@@ -37,53 +26,18 @@ from utils import (
     # _extract_cr_temp_field,
     _compute_djfm,
     get_provenance_record,
-    save_xarray_data,
+    write_xarray_data,
 )
 
 
 logger = logging.getLogger(Path(__file__).stem)
 
 
-def compute_diagnostic(filename, attributes, index):
-    logger.debug("Loading %s", filename)
-    logger.debug("Running example computation")
-    x = iris.load_cube(filename)
-    if index == "nao":
-        x_index = _extract_nao_ts(x)
-    elif index == "nino1":
-        x_index = _extract_nino1_ts(x)
-    elif index == "nino2":
-        x_index = _extract_nino2_ts(x)
-    elif index == "nino12":
-        x_index = _extract_nino12_ts(x)
-    elif index == "nino3":
-        x_index = _extract_nino3_ts(x)
-    elif index == "nino34":
-        x_index = _extract_nino34_ts(x)
-    elif index == "nino4":
-        x_index = _extract_nino4_ts(x)
-    elif index == "iod":
-        x_index = _extract_iod_ts(x)
-    elif index == "pdv":
-        x_index = _extract_pdv_ts(x)
-    elif index == "ipo":
-        x_index = _extract_ipo_ts(x)
-    elif index == "sahel_precip":
-        x_index = _extract_sahel_precip_ts(x)
-    elif index == "ea":
-        x_index = _extract_ea_ts(x)
-    elif index == "amv":
-        x_index = _extract_amv_ts(x)
-    elif index == "european_precip":
-        x_index = _extract_european_precip_ts(x)
-    elif index == "uk_precip":
-        x_index = _extract_uk_precip_ts(x)
-    elif index == "uk_temp":
-        x_index = _extract_uk_temp_ts(x)
+def _compute_index(x, filename, index, lead_windows=None):
+    if index == "precip_field":
+        x_index = _extract_precip_field(x)
     # elif index == "uk_precip_field":
     #     x_index = _extract_uk_precip_field(x)
-    elif index == "precip_field":
-        x_index = _extract_precip_field(x)
     elif index == "temp_field":
         x_index = _extract_temp_field(x)
     # elif index == "cr_precip_field":
@@ -91,11 +45,11 @@ def compute_diagnostic(filename, attributes, index):
     # elif index == "cr_temp_field":
     #     x_index = _extract_cr_temp_field(x)
     elif index == "psl_field":
-        x_index = _compute_djfm(x, filename)
+        x_index = _compute_djfm(x, filename, lead_windows=lead_windows)
     elif index == "tas_field":
-        x_index = _compute_djfm(x, filename)
+        x_index = _compute_djfm(x, filename, lead_windows=lead_windows)
     elif index == "pr_field":
-        x_index = _compute_djfm(x, filename)
+        x_index = _compute_djfm(x, filename, lead_windows=lead_windows)
     else:
         raise ValueError("Unrecognised index")
     ds = xarray.DataArray.from_iris(x_index)
@@ -103,25 +57,180 @@ def compute_diagnostic(filename, attributes, index):
     return ds
 
 
+def compute_diagnostic(filename, attributes, index, cache_dir=None, lead_windows=None):
+    results = compute_diagnostics(
+        filename, attributes, [index], cache_dir, lead_windows
+    )
+    return results[index]
+
+
+def compute_diagnostics(
+    filename, attributes, indices, cache_dir=None, lead_windows=None
+):
+    # Load the file once and evaluate each of `indices` against it
+    logger.debug("Loading %s", filename)
+    logger.debug("Running example computation")
+    x = iris.load_cube(filename)
+    # Indices of the registry are evaluated together in one matrix product
+    results = compute_indices(
+        x, [index for index in indices if index in INDEX_TERMS], cache_dir
+    )
+    for index in indices:
+        if index not in results:
+            results[index] = _compute_index(x, filename, index, lead_windows)
+    return {index: results[index] for index in indices}
+
+
+def _get_index_cfg(cfg, index):
+    # Configuration for one index of a multi-index diagnostic, whose
+    # outputs go where a diagnostic and script named after the index
+    # would write them (work/<index>/<index>), as for a single index
+    index_cfg = dict(cfg)
+    for key in ["work_dir", "plot_dir"]:
+        if key in cfg:
+            index_cfg[key] = os.path.join(Path(cfg[key]).parents[1], index, index)
+            os.makedirs(index_cfg[key], exist_ok=True)
+    index_cfg["index"] = index
+    return index_cfg
+
+
+def _process_dataset(
+    group_name,
+    attributes,
+    indices,
+    index_cfgs,
+    cache_dir=None,
+    lead_windows=None,
+    output_layout="files",
+):
+    # Compute the indices of one input file. With the "files" layout they
+    # are written here, returning the (filename, provenance record) of
+    # each output for the main process to log, since provenance is
+    # recorded in a single file per script; with "store" the results are
+    # returned, for the main process to gather into one store per index
+    logger.info("Processing dataset %s", attributes["dataset"])
+    input_file = attributes["filename"]
+    results = compute_diagnostics(
+        input_file, attributes, indices, cache_dir, lead_windows
+    )
+    if output_layout == "store":
+        return results
+    output_basename = Path(input_file).stem
+    if group_name != attributes["short_name"]:
+        output_basename = group_name + "_" + output_basename
+    provenance_record = get_provenance_record(attributes, ancestor_files=[input_file])
+    outputs = []
+    for index, ds in results.items():
+        filename = write_xarray_data(output_basename, index_cfgs[index], ds)
+        outputs.append((filename, provenance_record))
+    return outputs
+
+
+def _run_tasks(tasks, max_workers=1):
+    # Run _process_dataset on each task in `max_workers` processes,
+    # yielding each task with its outputs as it completes
+    if max_workers == 1:
+        for task in tasks:
+            yield task, _process_dataset(*task)
+        return
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_process_dataset, *task): task for task in tasks}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def _open_store(group_name, index, group, cfg):
+    # Store for the results of an index for every input file of a
+    # variable group, named as the per-file outputs are less the input
+    # file name
+    basename = index
+    if group_name != group[0]["short_name"]:
+        basename = group_name + "_" + index
+    return XarrayStore(
+        get_diagnostic_filename(basename, cfg),
+        index,
+        [attributes["filename"] for attributes in group],
+        cfg.get("output_encoding"),
+    )
+
+
+def _store_provenance(group):
+    # Provenance record of a store, with every input file written
+    # to it as an ancestor
+    attributes = dict(group[0])
+    attributes["dataset"] = ", ".join(sorted(set(a["dataset"] for a in group)))
+    attributes["start_year"] = min(a["start_year"] for a in group)
+    attributes["end_year"] = max(a["end_year"] for a in group)
+    ancestors = sorted(a["filename"] for a in group)
+    return get_provenance_record(attributes, ancestor_files=ancestors)
+
+
 def main(cfg):
     # Get a description of the preprocessed data that we will use as input.
     input_data = cfg["input_data"].values()
-    index = cfg["index"].lower()
+    # A list of indices is evaluated on each file in a single load
+    if isinstance(cfg["index"], str):
+        indices = [cfg["index"].lower()]
+        index_cfgs = {indices[0]: cfg}
+    else:
+        indices = [index.lower() for index in cfg["index"]]
+        index_cfgs = {index: _get_index_cfg(cfg, index) for index in indices}
     # Loop over datasets in alphabetical order
     groups = group_metadata(input_data, "variable_group", sort="dataset")
+    # The field indices can be averaged over several (start, end) lead
+    # time windows in one pass, e.g. lead_windows: [[2, 9], [2, 5], [6, 9]]
+    lead_windows = cfg.get("lead_windows")
+    if lead_windows is not None:
+        lead_windows = [tuple(window) for window in lead_windows]
+    # Each result is written to its own file ("files"), or into its slot
+    # of one store per index ("store", see XarrayStore) as it arrives
+    output_layout = cfg.get("output_layout", "files")
+    if output_layout not in ["files", "store"]:
+        raise ValueError("Unrecognised output_layout " + str(output_layout))
+    tasks = []
     for group_name in groups:
         logger.info("Processing variable %s", group_name)
         for attributes in groups[group_name]:
-            logger.info("Processing dataset %s", attributes["dataset"])
-            input_file = attributes["filename"]
-            ds = compute_diagnostic(input_file, attributes, index)
-            output_basename = Path(input_file).stem
-            if group_name != attributes["short_name"]:
-                output_basename = group_name + "_" + output_basename
-            provenance_record = get_provenance_record(
-                attributes, ancestor_files=[input_file]
+            tasks.append(
+                (
+                    group_name,
+                    attributes,
+                    indices,
+                    index_cfgs,
+                    cfg.get("weights_cache_dir"),
+                    lead_windows,
+                    output_layout,
+                )
             )
-            save_xarray_data(output_basename, provenance_record, cfg, ds)
+
+    # Datasets are processed by `max_workers` processes, with the
+    # provenance of every output collected here as datasets complete and
+    # recorded at the end, or every `provenance_flush_every` records
+    max_workers = cfg.get("max_workers", 1)
+    flush_every = cfg.get("provenance_flush_every")
+    stores = {}
+    written = {}
+    with ProvenanceCollector(cfg, flush_every) as provenance_logger:
+        try:
+            for task, outputs in _run_tasks(tasks, max_workers):
+                if output_layout == "files":
+                    for filename, record in outputs:
+                        provenance_logger.log(filename, record)
+                    continue
+                group_name, attributes = task[:2]
+                for index, ds in outputs.items():
+                    key = (group_name, index)
+                    if key not in stores:
+                        stores[key] = _open_store(
+                            group_name, index, groups[group_name], index_cfgs[index]
+                        )
+                    stores[key].write(attributes["filename"], ds)
+                    written.setdefault(key, []).append(attributes)
+        finally:
+            for store in stores.values():
+                store.close()
+        for key, store in stores.items():
+            provenance_logger.log(store.filename, _store_provenance(written[key]))
 
 
 if __name__ == "__main__":
@@ -5,9 +5,12 @@ from pathlib import Path
 from pprint import pformat
 
 import os
+import hashlib
+import threading
 import iris
 import numpy as np
 import xarray
+import netCDF4
 import re
 
 from esmvaltool.diag_scripts.shared import (
@@ -25,6 +28,13 @@ from esmvaltool.diag_scripts.shared import (
 
 logger = logging.getLogger(Path(__file__).stem)
 
+# Upper bound on the size of an output chunk with time-series chunking
+ENCODING_CHUNK_BYTES = 2**20
+
+# Approximate size of the headers and metadata of a small NetCDF-4 file;
+# savings are not logged for files whose data is smaller than this
+NETCDF_FILE_OVERHEAD = 16 * 2**10
+
 
 def get_provenance_record(attributes, ancestor_files):
     """Create a provenance record describing the diagnostic data and plot."""
@@ -50,7 +60,7 @@ def get_provenance_record(attributes, ancestor_files):
 
 
 # Adapted from ESMValTool/esmvaltool/diag_scripts/shared/_base.py
-def save_xarray_data(basename, provenance, cfg, ds, **kwargs):
+def save_xarray_data(basename, provenance, cfg, ds, provenance_logger=None, **kwargs):
     """Save the data used to create a plot to file.
 
     Parameters
@@ -63,6 +73,10 @@ def save_xarray_data(basename, provenance, cfg, ds, **kwargs):
         Dictionary with diagnostic configuration.
     cube: iris.cube.Cube
         Data cube to save.
+    provenance_logger: ProvenanceCollector, optional
+        Logger to record the provenance with, e.g. to record the
+        provenance of many files in batches. By default the provenance
+        is recorded in a session of its own.
     **kwargs:
         Extra keyword arguments to pass to :obj:`iris.save`.
 
@@ -76,15 +90,240 @@ def save_xarray_data(basename, provenance, cfg, ds, **kwargs):
             "Please use the `basename` argument to specify the output file"
         )
 
-    filename = get_diagnostic_filename(basename, cfg)
-    logger.info("Saving analysis results to %s", filename)
-    ds.to_netcdf(filename)
+    filename = write_xarray_data(basename, cfg, ds)
+    if provenance_logger is not None:
+        provenance_logger.log(filename, provenance)
+        return
     with ProvenanceLogger(cfg) as provenance_logger:
         provenance_logger.log(filename, provenance)
 
 
+class ProvenanceCollector:
+    """Collect provenance records and record them in batches.
+
+    Each :obj:`ProvenanceLogger` session reads and rewrites the provenance
+    file of the script, so records are kept in memory and recorded in one
+    session when the collector is closed or, with `flush_every`, each time
+    that many records have been collected. Records may be logged from
+    several threads; records of worker processes are logged by the main
+    process, e.g. as returned by the workers.
+
+    Parameters
+    ----------
+    cfg: dict
+        Dictionary with diagnostic configuration.
+    flush_every: int, optional
+        Number of records after which they are recorded. By default they
+        are all recorded when the collector is closed.
+    """
+
+    def __init__(self, cfg, flush_every=None):
+        self._cfg = cfg
+        self._flush_every = flush_every
+        self._records = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def log(self, filename, record):
+        """Collect the provenance record of a file."""
+        with self._lock:
+            self._records.append((filename, record))
+            if self._flush_every is not None:
+                if len(self._records) >= self._flush_every:
+                    self._flush()
+
+    def flush(self):
+        """Record the collected records in one session."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        records, self._records = self._records, []
+        if len(records) == 0:
+            return
+        with ProvenanceLogger(self._cfg) as provenance_logger:
+            for filename, record in records:
+                provenance_logger.log(filename, record)
+
+
+def write_xarray_data(basename, cfg, ds):
+    """Write data to file without recording its provenance.
+
+    The provenance of the file must then be logged by the caller, e.g.
+    by the main process when datasets are written by worker processes.
+
+    Parameters
+    ----------
+    basename: str
+        The basename of the file.
+    cfg: dict
+        Dictionary with diagnostic configuration.
+    ds: xarray.DataArray
+        Data to save.
+
+    Returns
+    -------
+    str
+        The name of the file written.
+    """
+    filename = get_diagnostic_filename(basename, cfg)
+    logger.info("Saving analysis results to %s", filename)
+    policy = cfg.get("output_encoding", {})
+    ds.to_netcdf(filename, encoding=_get_encoding(ds, policy))
+    if len(policy) > 0:
+        written = os.path.getsize(filename)
+        msg = "Wrote %d bytes for %d unencoded bytes of %s"
+        args = [written, ds.nbytes, ds.name]
+        if ds.nbytes >= NETCDF_FILE_OVERHEAD:
+            msg += " (%.0f%% saved)"
+            args.append(100 * (1 - written / ds.nbytes))
+        logger.info(msg, *args)
+    return filename
+
+
+def _encoding_chunks(shape, chunking, itemsize):
+    # Chunk shape with the leading (time) dimension first. "time" chunking
+    # keeps whole time series together, tiling the other dimensions so that
+    # a chunk stays within ENCODING_CHUNK_BYTES; "map" chunking holds one
+    # time step of every other dimension per chunk
+    shape = list(shape)
+    if chunking == "map":
+        return [1] + shape[1:]
+    chunks = list(shape)
+    while np.prod(chunks) * itemsize > ENCODING_CHUNK_BYTES:
+        # Halve the largest of the other dimensions
+        i = 1 + int(np.argmax(chunks[1:])) if len(chunks) > 1 else 0
+        if i == 0 or chunks[i] == 1:
+            break
+        chunks[i] = (chunks[i] + 1) // 2
+    return chunks
+
+
+def _get_encoding(ds, policy):
+    # xarray encoding of a diagnostic DataArray under the `output_encoding`
+    # policy of the recipe script: any of dtype, zlib, complevel, shuffle
+    # and significant_digits, plus chunking ("time" or "map")
+    if len(policy) == 0:
+        return {}
+    encoding = {k: v for k, v in policy.items() if k != "chunking"}
+    if ds.ndim > 0:
+        itemsize = np.dtype(policy.get("dtype", ds.dtype)).itemsize
+        chunks = _encoding_chunks(ds.shape, policy.get("chunking", "time"), itemsize)
+        encoding["chunksizes"] = tuple(chunks)
+    return {ds.name: encoding}
+
+
+# The box weight helpers below are also copied in
+# 03_process-ncar-prec-data.py; fixes must be made in both
+def _grid_hash(x):
+    # Hash of the horizontal grid of an Iris cube, used to key
+    # cached box weights
+    h = hashlib.sha1()
+    for coord in [x.coord("latitude"), x.coord("longitude")]:
+        h.update(np.ascontiguousarray(coord.points, dtype=np.float64).tobytes())
+        if coord.has_bounds():
+            h.update(np.ascontiguousarray(coord.bounds, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def _build_box_weights(x, xmin, xmax, ymin, ymax):
+    # Area weights of the cells Cube.intersection selects for the box
+    lat = x.coord("latitude").copy()
+    lon = x.coord("longitude").copy()
+    shape = (lat.shape[0], lon.shape[0])
+    template = iris.cube.Cube(np.arange(shape[0] * shape[1]).reshape(shape))
+    template.add_dim_coord(lat, 0)
+    template.add_dim_coord(lon, 1)
+    box = template.intersection(longitude=(xmin, xmax), latitude=(ymin, ymax))
+    grid_areas = iris.analysis.cartography.area_weights(box)
+    weights = np.zeros(shape[0] * shape[1])
+    np.add.at(weights, box.data.ravel(), grid_areas.ravel())
+    weights = weights.reshape(shape) / weights.sum()
+
+    # Scalar coordinates of the collapsed box
+    box = box.collapsed(
+        ["latitude", "longitude"], iris.analysis.MEAN, weights=grid_areas
+    )
+    box_coords = [box.coord("latitude"), box.coord("longitude")]
+    return weights, box_coords
+
+
+def _save_box_weights(cache_fn, weights, box_coords):
+    # Write to a temporary file first so that concurrent
+    # diagnostics never read a partially written cache
+    os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+    tmp_fn = cache_fn + "." + str(os.getpid()) + ".tmp.npz"
+    np.savez(
+        tmp_fn,
+        weights=weights,
+        points=np.array([coord.points[0] for coord in box_coords]),
+        bounds=np.array([coord.bounds[0] for coord in box_coords]),
+        circular=np.array([getattr(coord, "circular", False) for coord in box_coords]),
+    )
+    os.replace(tmp_fn, cache_fn)
+
+
+def _load_box_weights(cache_fn, x):
+    # The box coordinates are rebuilt from the grid coordinates of `x`,
+    # which the cache key guarantees have the cached points and bounds
+    with np.load(cache_fn) as f:
+        weights = f["weights"]
+        box_coords = []
+        for i, name in enumerate(["latitude", "longitude"]):
+            coord = x.coord(name).copy(
+                points=f["points"][i : i + 1], bounds=f["bounds"][i : i + 1]
+            )
+            if hasattr(coord, "circular"):
+                coord.circular = bool(f["circular"][i])
+            box_coords.append(coord)
+    return weights, box_coords
+
+
+# Normalized area weights for each (grid hash, box) in the current process
+_BOX_WEIGHTS = {}
+
+
+def _get_box_weights(x, xmin, xmax, ymin, ymax, cache_dir=None):
+    # Weights are kept for the rest of the process and, with `cache_dir`,
+    # on disk, where later runs and other diagnostics on the same grid
+    # (e.g. the common 5 degree grid of the s20 recipes) reuse them
+    key = (_grid_hash(x), xmin, xmax, ymin, ymax)
+    if key in _BOX_WEIGHTS:
+        return _BOX_WEIGHTS[key]
+
+    cache_fn = None
+    if cache_dir is not None:
+        cache_fn = os.path.join(
+            cache_dir,
+            "box_" + "_".join([key[0][:16]] + [str(v) for v in key[1:]]) + ".npz",
+        )
+    if cache_fn is not None and os.path.exists(cache_fn):
+        _BOX_WEIGHTS[key] = _load_box_weights(cache_fn, x)
+    else:
+        _BOX_WEIGHTS[key] = _build_box_weights(x, xmin, xmax, ymin, ymax)
+        if cache_fn is not None:
+            _save_box_weights(cache_fn, *_BOX_WEIGHTS[key])
+    return _BOX_WEIGHTS[key]
+
+
+def _apply_box_weights(data, weights, y_dim, x_dim):
+    # Weighted box mean, renormalized over the unmasked points
+    axes = ([y_dim, x_dim], [0, 1])
+    if not np.ma.is_masked(data):
+        return np.tensordot(np.ma.getdata(data), weights, axes=axes)
+    mask = np.ma.getmaskarray(data)
+    total = np.tensordot(np.ma.filled(data, 0), weights, axes=axes)
+    norm = np.tensordot(~mask, weights, axes=axes)
+    mean = np.divide(total, norm, out=np.zeros_like(total), where=norm > 0)
+    return np.ma.masked_where(norm == 0, mean)
+
+
 def _extract_ts(x, xmin, xmax, ymin, ymax):
-    x_copy = x.copy()
     # lon_name = get_longitude_name(x_copy)
     # lat_name = get_latitude_name(x_copy)
     # if (x_copy.coord(lon_name).bounds is None):
@@ -93,17 +332,78 @@ def _extract_ts(x, xmin, xmax, ymin, ymax):
     #     x_copy.coord(lat_name).guess_bounds()
     # positive_lon = has_positive_longitude(x_copy)
     # xmin, xmax = transform_longitude(xmin, xmax, positive_lon)
-    box = x_copy.intersection(longitude=(xmin, xmax), latitude=(ymin, ymax))
-    grid_areas = iris.analysis.cartography.area_weights(box)
-    ts = box.collapsed(
-        ["latitude", "longitude"], iris.analysis.MEAN, weights=grid_areas
-    )
+    weights, box_coords = _get_box_weights(x, xmin, xmax, ymin, ymax)
+    y_dim = x.coord_dims("latitude")[0]
+    x_dim = x.coord_dims("longitude")[0]
+    data = _apply_box_weights(x.data, weights, y_dim, x_dim)
+
+    # Take the remaining coordinates from a single grid point
+    index = [slice(None)] * x.ndim
+    index[y_dim] = 0
+    index[x_dim] = 0
+    ts = x[tuple(index)]
+    for coord in box_coords:
+        ts.remove_coord(coord.name())
+        ts.add_aux_coord(coord.copy())
+    ts.data = data
+    ts.add_cell_method(iris.coords.CellMethod("mean", coords=["latitude", "longitude"]))
     return ts
 
 
+def _build_field_index(x, xmin, xmax, ymin, ymax):
+    # As for the box weights, run the Iris intersection on a template cube
+    # of flat cell indices, and turn the selected cells into a latitude
+    # slice and one longitude slice per contiguous run of cells (two when
+    # the box crosses the longitude wraparound)
+    lat = x.coord("latitude").copy()
+    lon = x.coord("longitude").copy()
+    shape = (lat.shape[0], lon.shape[0])
+    template = iris.cube.Cube(np.arange(shape[0] * shape[1]).reshape(shape))
+    template.add_dim_coord(lat, 0)
+    template.add_dim_coord(lon, 1)
+    box = template.intersection(longitude=(xmin, xmax), latitude=(ymin, ymax))
+    rows = box.data[:, 0] // shape[1]
+    cols = box.data[0, :] % shape[1]
+    lat_index = slice(rows[0], rows[-1] + 1)
+    if np.any(np.diff(rows) != 1):
+        lat_index = rows
+    runs = np.split(cols, np.flatnonzero(np.diff(cols) != 1) + 1)
+    lon_slices = [slice(run[0], run[-1] + 1) for run in runs]
+    box_coords = [box.coord("latitude"), box.coord("longitude")]
+    return lat_index, lon_slices, box_coords
+
+
+# Index of the cells of each (grid hash, box) in the current process
+_FIELD_INDEX = {}
+
+
+def _get_field_index(x, xmin, xmax, ymin, ymax):
+    # The subset takes its longitude coordinate, including the circular
+    # flag, from the cached index
+    circular = getattr(x.coord("longitude"), "circular", False)
+    key = (_grid_hash(x), circular, xmin, xmax, ymin, ymax)
+    if key not in _FIELD_INDEX:
+        _FIELD_INDEX[key] = _build_field_index(x, xmin, xmax, ymin, ymax)
+    return _FIELD_INDEX[key]
+
+
 def _extract_field(x, xmin, xmax, ymin, ymax):
-    x_copy = x.copy()
-    subset = x_copy.intersection(longitude=(xmin, xmax), latitude=(ymin, ymax))
+    # Index the box directly rather than copying the whole field for
+    # Cube.intersection, so that only the box itself is copied; a box
+    # crossing the wraparound is indexed by the cells of its two slices
+    # and given the longitudes Cube.intersection would give it
+    lat_index, lon_slices, box_coords = _get_field_index(x, xmin, xmax, ymin, ymax)
+    y_dim = x.coord_dims("latitude")[0]
+    x_dim = x.coord_dims("longitude")[0]
+    index = [slice(None)] * x.ndim
+    index[y_dim] = lat_index
+    index[x_dim] = lon_slices[0]
+    if len(lon_slices) > 1:
+        index[x_dim] = np.concatenate([np.arange(s.start, s.stop) for s in lon_slices])
+    subset = x[tuple(index)]
+    for coord, dim in zip(box_coords, [y_dim, x_dim]):
+        subset.remove_coord(coord.name())
+        subset.add_dim_coord(coord.copy(), dim)
     return subset
 
 # def compute_djfm(x): #, varname):
@@ -161,195 +461,611 @@ def parse_filepath(fpath):
     return out
 
 
-def _compute_djfm(x, filename, start_year=2, end_year=9):
+# Dimensions of a store and the parse_filepath keys that label them
+STORE_DIMS = [
+    ("project", "project"),
+    ("model", "model"),
+    ("init_year", "init_year"),
+    ("member", "ensemble"),
+]
+
+
+class XarrayStore:
+    """Write the results of one index for many input files to one store.
+
+    The results are labelled by the project, model, initialization year
+    and member given by :func:`parse_filepath`, and each is written into
+    its slot of a chunked NetCDF4 file as it arrives, so that the results
+    are never held in memory together. Slots without a result are NaN,
+    and a ``complete`` flag records which have been written. As in the
+    product stores of the NCAR script, time becomes a lead_month
+    dimension, since the valid times differ between initialization years;
+    they are kept as valid_year and valid_month, which unlike times can
+    be shared between calendars.
+
+    Parameters
+    ----------
+    filename: str
+        Name of the store file.
+    name: str
+        Name of the index.
+    input_files: list of str
+        Input files whose results may be written, which give the labels.
+    policy: dict, optional
+        The ``output_encoding`` policy of the recipe script.
+    """
+
+    def __init__(self, filename, name, input_files, policy=None):
+        self.filename = filename
+        self.name = name
+        self._policy = {} if policy is None else policy
+        metas = [parse_filepath(input_file) for input_file in input_files]
+        self._labels = [
+            sorted(set(meta[key] for meta in metas)) for _, key in STORE_DIMS
+        ]
+        self._nc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, input_file, ds):
+        """Write the result for an input file into its slot."""
+        if self._nc is None:
+            self._create(ds)
+        meta = parse_filepath(input_file)
+        key = tuple(
+            values.index(meta[meta_key])
+            for values, (_, meta_key) in zip(self._labels, STORE_DIMS)
+        )
+        if self._nc["complete"][key]:
+            raise ValueError("More than one " + self.name + " result for " + input_file)
+        if {dim: ds.sizes.get(dim) for dim in self._other_dims} != self._sizes:
+            raise ValueError(
+                "Result of "
+                + self.name
+                + " for "
+                + input_file
+                + " has dimensions "
+                + str(dict(ds.sizes))
+                + ", expected "
+                + str(self._sizes)
+            )
+        var = self._nc[self.name]
+        if self._time_dim is None:
+            var[key] = ds.transpose(*self._other_dims).values
+        else:
+            lead = slice(0, ds.sizes[self._time_dim])
+            values = ds.transpose(self._time_dim, *self._other_dims).values
+            var[key + (lead,)] = values
+            self._nc["lead_month"][lead] = np.arange(ds.sizes[self._time_dim])
+            self._nc["valid_year"][key[:3] + (lead,)] = ds["time"].dt.year.values
+            self._nc["valid_month"][key[:3] + (lead,)] = ds["time"].dt.month.values
+        self._nc["complete"][key] = 1
+
+    def close(self):
+        """Close the store file."""
+        if self._nc is not None:
+            self._nc.close()
+            self._nc = None
+
+    def _create(self, template):
+        # Create the store from the first result written. The coordinates
+        # are written by xarray, which encodes their strings and times;
+        # lead_month is unlimited, since results may differ in length
+        self._time_dim = None
+        if "time" in template.coords and template["time"].ndim == 1:
+            self._time_dim = template["time"].dims[0]
+        self._other_dims = [dim for dim in template.dims if dim != self._time_dim]
+        self._sizes = {dim: template.sizes[dim] for dim in self._other_dims}
+        dims = [dim for dim, _ in STORE_DIMS]
+        coords = {dim: values for dim, values in zip(dims, self._labels)}
+        scalar_coords = []
+        for coord_name, coord in template.coords.items():
+            if coord_name == "time" and self._time_dim is not None:
+                continue
+            if all(dim in self._other_dims for dim in coord.dims):
+                coords[coord_name] = coord.variable
+                if coord_name not in template.dims:
+                    scalar_coords.append(coord_name)
+        logger.info("Saving analysis results to %s", self.filename)
+        xarray.Dataset(coords=coords).to_netcdf(self.filename)
+
+        nc = netCDF4.Dataset(self.filename, "a")
+        store_dims = list(dims)
+        chunks = [template.sizes[dim] for dim in self._other_dims]
+        if self._time_dim is not None:
+            nc.createDimension("lead_month", None)
+            lead_month = nc.createVariable("lead_month", "i4", ("lead_month",))
+            lead_month.long_name = "months since the start of the hindcast"
+            for coord_name in ["valid_year", "valid_month"]:
+                nc.createVariable(
+                    coord_name, "i4", tuple(dims[:3]) + ("lead_month",), fill_value=-1
+                )
+            scalar_coords += ["valid_year", "valid_month"]
+            store_dims.append("lead_month")
+            chunks.insert(0, template.sizes[self._time_dim])
+        for dim in self._other_dims:
+            if dim not in nc.dimensions:
+                nc.createDimension(dim, template.sizes[dim])
+        store_dims += self._other_dims
+        policy = self._policy
+        dtype = np.dtype(
+            policy.get("dtype", np.result_type(template.dtype, np.float32))
+        )
+        if len(policy) > 0 and len(chunks) > 0:
+            chunks = _encoding_chunks(
+                chunks, policy.get("chunking", "time"), dtype.itemsize
+            )
+        var = nc.createVariable(
+            self.name,
+            dtype,
+            tuple(store_dims),
+            chunksizes=(1,) * len(dims) + tuple(chunks),
+            fill_value=np.nan,
+            zlib=policy.get("zlib", False),
+            complevel=policy.get("complevel", 4),
+            shuffle=policy.get("shuffle", True),
+            significant_digits=policy.get("significant_digits"),
+        )
+        var.setncatts(template.attrs)
+        if len(scalar_coords) > 0:
+            var.coordinates = " ".join(scalar_coords)
+        complete = nc.createVariable("complete", "i1", tuple(dims))
+        complete[:] = 0
+        complete.long_name = "whether a result has been written for the slot"
+        self._nc = nc
+
+
+# The season helpers below are also copied in
+# 03_process-ncar-prec-data.py; fixes must be made in both
+def _season_months(season):
+    # First month and length of a season, e.g. "djfm"
+    months = "jfmamjjasond"
+    first = (months * 2).find(season.lower())
+    if len(season) == 0 or len(season) > 12 or first < 0:
+        raise ValueError("Unrecognised season " + season)
+    return first + 1, len(season)
+
+
+def _season_index(years, months, season):
+    # (season year, month of season) array of time positions, or -1
+    first, length = _season_months(season)
+    offset = (months - first) % 12
+    steps = np.flatnonzero(offset < length)
+    if steps.size == 0:
+        return np.zeros(0, dtype=int), np.zeros((0, length), dtype=int)
+    offset = offset[steps]
+    season_years = years[steps] + (months[steps] + length - 2 - offset) // 12
+    rows = season_years - season_years.min()
+    index = np.full((rows.max() + 1, length), -1)
+    counts = np.zeros(index.shape, dtype=int)
+    np.add.at(counts, (rows, offset), 1)
+    index[rows, offset] = steps
+    index[counts > 1] = -1
+    return np.arange(season_years.min(), season_years.max() + 1), index
+
+
+def _seasonal_means(data, index, time_axis=0):
+    # Means over each complete season of `index`, and the complete seasons
+    complete = np.all(index >= 0, axis=1)
+    rows = index[complete]
+    data = np.moveaxis(data, time_axis, 0)
+    if np.ma.is_masked(data):
+        data = np.ma.filled(data, np.nan)
+    else:
+        data = np.ma.getdata(data)
+    starts = rows[:, 0]
+    length = index.shape[1]
+    if (
+        starts.size > 0
+        and np.all(rows == starts[:, None] + np.arange(length))
+        and np.all(np.diff(starts) == 12)
+    ):
+        windows = np.lib.stride_tricks.sliding_window_view(data, length, axis=0)
+        means = windows[starts[0] : starts[-1] + 1 : 12].mean(axis=-1)
+    else:
+        means = data[rows].mean(axis=1)
+    return means, complete
+
+
+def _lead_window_means(means, lead_time, lead_windows):
+    # Mean of the seasonal `means` (along the leading axis, in increasing
+    # `lead_time`) over each (start, end) lead window, from the differences
+    # of a single cumulative sum over the seasons. A window is NaN if any
+    # of its seasons is NaN or it holds no season
+    for start, end in lead_windows:
+        if start > end:
+            raise ValueError("Invalid lead window " + str(start) + "-" + str(end))
+    missing = np.isnan(means)
+    sums = np.zeros((means.shape[0] + 1,) + means.shape[1:])
+    np.cumsum(np.where(missing, 0, means), axis=0, out=sums[1:])
+    n_missing = np.concatenate(
+        [np.zeros((1,) + means.shape[1:], dtype=int), np.cumsum(missing, axis=0)]
+    )
+    lo = np.searchsorted(lead_time, [start for start, _ in lead_windows], side="left")
+    hi = np.searchsorted(lead_time, [end for _, end in lead_windows], side="right")
+    count = (hi - lo).reshape((-1,) + (1,) * (means.ndim - 1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        window_means = (sums[hi] - sums[lo]) / count
+    window_means[n_missing[hi] - n_missing[lo] > 0] = np.nan
+    return window_means.astype(means.dtype)
+
+
+def _add_lead_window_dim(mean, data, lead_windows):
+    # Cube with the metadata and coordinates of `mean` and the given
+    # data, which has a leading dimension of `lead_windows`
+    cube = iris.cube.Cube(data)
+    cube.metadata = mean.metadata
+    cube.add_dim_coord(
+        iris.coords.DimCoord(
+            np.arange(len(lead_windows)),
+            long_name="lead_window",
+            var_name="lead_window",
+            units="1",
+        ),
+        0,
+    )
+    for i, name in enumerate(["lead_start", "lead_end"]):
+        cube.add_aux_coord(
+            iris.coords.AuxCoord(
+                [window[i] for window in lead_windows], var_name=name, units="1"
+            ),
+            0,
+        )
+    for coord in mean.dim_coords:
+        cube.add_dim_coord(coord.copy(), mean.coord_dims(coord)[0] + 1)
+    for coord in mean.aux_coords:
+        cube.add_aux_coord(coord.copy(), [dim + 1 for dim in mean.coord_dims(coord)])
+    return cube
+
+
+def _compute_season_mean(
+    x, init_year, season, start_year=2, end_year=9, lead_windows=None
+):
+    # Mean over the complete seasons with lead times from `start_year` to
+    # `end_year`, or over each of `lead_windows` along a new leading dimension
+    time = x.coord("time")
+    time_dim = x.coord_dims(time)[0]
+    dates = time.units.num2date(time.points)
+    years = np.array([date.year for date in dates])
+    months = np.array([date.month for date in dates])
+    season_years, index = _season_index(years, months, season)
+    means, complete = _seasonal_means(x.data, index, time_dim)
+    lead_time = season_years[complete] - int(init_year)
+    windows = [(start_year, end_year)] if lead_windows is None else lead_windows
+    data = _lead_window_means(means, lead_time, windows)
+    if np.ma.is_masked(x.data):
+        data = np.ma.masked_invalid(data)
+
+    # Metadata from a single time step, less the time coordinates
+    mean = x.copy(data=x.core_data())
+    for coord in x.coords(dimensions=time_dim):
+        mean.remove_coord(coord.name())
+    head = [slice(None)] * x.ndim
+    head[time_dim] = 0
+    mean = mean[tuple(head)]
+    if lead_windows is not None:
+        return _add_lead_window_dim(mean, data, lead_windows)
+    mean.data = data[0]
+    return mean
+
+
+def _compute_djfm(x, filename, start_year=2, end_year=9, lead_windows=None):
     # Compute the mean value for DJFM season.
     #
     # Args:
-    #   x         : Iris dataset.
-    #   varname   : string. Variable name.
-    #   init_year : int. Initialization year of `ds`.
-    #   start_year: int. Start forecast lead time.
-    #   end_year  : int. End forecast lead time.
+    #   x           : Iris dataset.
+    #   filename    : string. File name, giving the initialization year.
+    #   start_year  : int. Start forecast lead time.
+    #   end_year    : int. End forecast lead time.
+    #   lead_windows: list of (start_year, end_year), or None. Lead time
+    #                 windows to average over in one pass, instead of
+    #                 `start_year` to `end_year`.
     #
     # Returns:
-    #   xarray dataset.
+    #   Iris cube, with a leading lead_window dimension
+    #   if `lead_windows` is given.
 
     meta = parse_filepath(filename)
     init_year = int(meta["init_year"])
+    return _compute_season_mean(
+        x, init_year, "djfm", start_year, end_year, lead_windows
+    )
 
-    da = xarray.DataArray.from_iris(x)
-    varname = str(da.name)
-    ds = da.to_dataset()
-
-    # Sometimes Iris "fixes" a non-monotonic time
-    # dimension by adding another dimension
-    # called 'dim_0' - account for this here
-    dimnames = list(ds.dims.keys())
-    time_dimname = "time"
-    if "time" not in dimnames:
-        if "dim_0" in dimnames:
-            time_dimname = "dim_0"
-        else:
-            if len(dimnames) == 1:
-                time_dimname = dimnames[0]
-            else:
-                raise ValueError("Ambiguous time dimension")
-
-    # # If variable is preciptation we need to convert kg m-2 s-1 to mm/day
-    # if varname == 'pr':
-    #     # days_in_month = ds[time_dimname].dt.days_in_month
-    #     # ds[varname] *= (days_in_month * 60 * 60 * 24) # mm/month
-    #     ds[varname] *= (60 * 60 * 24) # mm/day
-
-    ds["counter"] = (
-        (time_dimname,),
-        [
-            1,
+
+# Indices as weighted sums of terms: the area-weighted mean over a
+# ("box", (xmin, xmax, ymin, ymax)) or the value at the grid point
+# nearest to a ("point", (x, y)), each with its weight
+INDEX_TERMS = {
+    "nao": [("box", (-28, -20, 36, 40), 1.0), ("box", (-25, -16, 63, 70), -1.0)],
+    # NINO indices require SST
+    "nino1": [("box", (270, 280, -10, -5), 1.0)],
+    "nino2": [("box", (270, 280, -5, 0), 1.0)],
+    "nino12": [("box", (270, 280, -10, 0), 1.0)],
+    "nino3": [("box", (210, 270, -5, 5), 1.0)],
+    "nino34": [("box", (190, 240, -5, 5), 1.0)],
+    "nino4": [("box", (160, 210, -5, 5), 1.0)],
+    # Dipole Mode Index [DMI - https://psl.noaa.gov/gcos_wgsp/Timeseries/DMI/]
+    # SST
+    "iod": [("box", (50, 70, -10, 10), 1.0), ("box", (90, 110, -10, 0), -1.0)],
+    # Pacific Decadal Variability [PDV]
+    # SST
+    "pdv": [("box", (200, 250, -10, 6), 1.0), ("box", (180, 215, 30, 45), -1.0)],
+    # Interdecadal Pacific Oscillation
+    # SST
+    "ipo": [
+        ("box", (170, 270, -10, 10), 1.0),
+        ("box", (140, 215, 25, 45), -0.5),
+        ("box", (150, 200, -50, -15), -0.5),
+    ],
+    # East Atlantic
+    # MSLP
+    "ea": [("point", (-27.5, 52.5), 1.0)],
+    # Atlantic Multidecadal Variability
+    # T
+    "amv": [("box", (-80, 0, 0, 60), 1.0), ("box", (-180, 180, -60, 60), -1.0)],
+    # Northern Europe precipitation
+    # P
+    "european_precip": [("box", (-10, 25, 55, 70), 1.0)],
+    # UK precipitation
+    # P
+    "uk_precip": [("box", (-8, 2, 50, 59), 1.0)],
+    # UK temperature
+    # T
+    "uk_temp": [("box", (-8, 2, 50, 59), 1.0)],
+    # Sahelian preciptiation
+    # P
+    "sahel_precip": [("box", (-16, 36, 10, 20), 1.0)],
+}
+
+
+def _matlab_mod(a, b):
+    return a - b * np.floor(a / b)
+
+
+def _build_axis_index(points):
+    # Nearest-point lookup along a monotonic grid axis: the points in
+    # ascending order and their spacing if it is regular, else None
+    points = np.asarray(points, dtype=np.float64)
+    descending = points.size > 1 and points[-1] < points[0]
+    points = points[::-1] if descending else points
+    step = None
+    if points.size > 1 and np.allclose(np.diff(points), points[1] - points[0]):
+        step = points[1] - points[0]
+    return points, step, descending
+
+
+def _axis_nearest(axis_index, value):
+    # Index of the point nearest to `value`. The point below `value` is
+    # found by arithmetic on a regular axis and by binary search otherwise;
+    # ties go to the larger point, as with xarray's nearest selection
+    points, step, descending = axis_index
+    if points.size == 1:
+        return 0
+    if step is not None:
+        i = int(np.floor((value - points[0]) / step))
+    else:
+        i = int(np.searchsorted(points, value, side="right")) - 1
+    i = min(max(i, 0), points.size - 2)
+    if abs(points[i + 1] - value) <= abs(value - points[i]):
+        i += 1
+    return points.size - 1 - i if descending else i
+
+
+# Nearest-point lookups of the (lat, lon) axes
+# of each grid hash in the current process
+_POINT_INDEX = {}
+
+
+def _nearest_point(x, xcoord, ycoord):
+    # (lat, lon) indices of the grid point nearest to (xcoord, ycoord)
+    key = _grid_hash(x)
+    if key not in _POINT_INDEX:
+        _POINT_INDEX[key] = [
+            _build_axis_index(x.coord(name).points)
+            for name in ["latitude", "longitude"]
         ]
-        * len(ds.time),
+    lat_index, lon_index = _POINT_INDEX[key]
+    return (
+        _axis_nearest(lat_index, ycoord),
+        _axis_nearest(lon_index, _matlab_mod(xcoord, 360.0)),
     )
-    ds = ds.groupby("season_year").sum(time_dimname)
-    # Limit dataset to complete [boreal winter] seasons
-    complete_index = ds["counter"].values == 4
-    ds = ds.sel(season_year=complete_index)
 
-    # Divide by four to get mean value
-    # if varname != 'pr':
-    ds[varname] = ds[varname] / 4
 
-    # Add lead time
-    # [N.B. season_year (added automatically by Iris)
-    # defines the year of final month in the season]
-    ds["lead_time"] = (("season_year",), ds.season_year.values - int(init_year))
+def _extract_point_ts(x, xcoord, ycoord):
+    # Value at the grid point nearest to (xcoord, ycoord)
+    j, k = _nearest_point(x, xcoord, ycoord)
+    index = [slice(None)] * x.ndim
+    index[x.coord_dims("latitude")[0]] = j
+    index[x.coord_dims("longitude")[0]] = k
+    return x[tuple(index)]
 
-    def _is_yr2to9(year):  # , init_year):
-        return (year >= start_year) & (year <= end_year)
 
-    ds = ds.sel(season_year=_is_yr2to9(ds["lead_time"]))
-    # ds = ds.drop(['counter','lead_time'])
-    ds = ds.mean("season_year")
-    da = ds[varname].to_iris()
-    return da
+def _extract_index_ts(x, index):
+    # Evaluate an index of INDEX_TERMS with Iris. Terms with the same
+    # weight are added before weighting, e.g. IPO is evaluated as
+    # middle - 0.5 * (northern + southern)
+    groups = {}
+    for kind, region, weight in INDEX_TERMS[index]:
+        if kind == "box":
+            term = _extract_ts(x, *region)
+        else:
+            term = _extract_point_ts(x, *region)
+        groups[weight] = term if weight not in groups else groups[weight] + term
+    ts = None
+    for weight, group in groups.items():
+        if ts is None:
+            ts = group if weight == 1 else weight * group
+        elif weight == 1:
+            ts = ts + group
+        elif weight == -1:
+            ts = ts - group
+        elif weight < 0:
+            ts = ts - -weight * group
+        else:
+            ts = ts + weight * group
+    return ts
+
+
+def _build_index_weights(x, indices, cache_dir=None):
+    # Weights of each distinct term of `indices` over the flattened
+    # (lat, lon) grid, stacked into one matrix, and the weight of each
+    # term in each index
+    lat = x.coord("latitude").points
+    lon = x.coord("longitude").points
+    terms = []
+    for index in indices:
+        for kind, region, _ in INDEX_TERMS[index]:
+            if (kind, region) not in terms:
+                terms.append((kind, region))
+    weights = np.zeros((len(terms), lat.size * lon.size))
+    for i, (kind, region) in enumerate(terms):
+        if kind == "box":
+            weights[i] = _get_box_weights(x, *region, cache_dir)[0].ravel()
+        else:
+            j, k = _nearest_point(x, *region)
+            weights[i, j * lon.size + k] = 1.0
+    combination = np.zeros((len(terms), len(indices)))
+    for j, index in enumerate(indices):
+        for kind, region, weight in INDEX_TERMS[index]:
+            combination[terms.index((kind, region)), j] += weight
+    return weights, combination
+
+
+# Stacked term weights and combinations for each
+# (grid hash, indices) in the current process
+_INDEX_WEIGHTS = {}
+
+
+def _get_index_weights(x, indices, cache_dir=None):
+    key = (_grid_hash(x), tuple(indices))
+    if key not in _INDEX_WEIGHTS:
+        _INDEX_WEIGHTS[key] = _build_index_weights(x, indices, cache_dir)
+    return _INDEX_WEIGHTS[key]
+
+
+def _apply_index_weights(data, weights, combination, y_dim, x_dim):
+    # Every term mean in one matrix product over the (..., lat x lon)
+    # data, then the indices as combinations of the terms. As with
+    # _apply_box_weights, masked points are excluded by renormalizing
+    # each term, and terms with no unmasked points are NaN
+    data = np.moveaxis(data, [y_dim, x_dim], [-2, -1])
+    shape = data.shape[:-2]
+    data = data.reshape(-1, weights.shape[1])
+    if np.ma.is_masked(data):
+        total = np.ma.filled(data, 0) @ weights.T
+        norm = ~np.ma.getmaskarray(data) @ weights.T
+        terms = np.full_like(total, np.nan)
+        np.divide(total, norm, out=terms, where=norm > 0)
+    else:
+        terms = np.ma.getdata(data) @ weights.T
+    # An index is NaN where any of its own terms is
+    missing = np.isnan(terms)
+    values = np.where(missing, 0, terms) @ combination
+    values[missing @ (combination != 0)] = np.nan
+    return values.reshape(shape + (combination.shape[1],))
+
+
+def compute_indices(x, indices, cache_dir=None):
+    # Evaluate several INDEX_TERMS indices of a cube with a single matrix
+    # product. The metadata of each index is that of its Iris evaluation
+    # on the first time step, with the coordinates of the full cube. Box
+    # weights are cached in `cache_dir`, if given (see _get_box_weights)
+    if len(indices) == 0:
+        return {}
+    y_dim = x.coord_dims("latitude")[0]
+    x_dim = x.coord_dims("longitude")[0]
+    weights, combination = _get_index_weights(x, indices, cache_dir)
+    values = _apply_index_weights(x.data, weights, combination, y_dim, x_dim)
+
+    head = [slice(0, 1)] * x.ndim
+    point = [slice(None)] * x.ndim
+    for dim in [y_dim, x_dim]:
+        head[dim] = slice(None)
+        point[dim] = 0
+    head = x[tuple(head)]
+    point = xarray.DataArray.from_iris(x[tuple(point)])
+    coords = {k: v for k, v in point.coords.items() if v.ndim > 0}
+    results = {}
+    for j, index in enumerate(indices):
+        template = xarray.DataArray.from_iris(_extract_index_ts(head, index))
+        index_coords = {k: v for k, v in template.coords.items() if v.ndim == 0}
+        index_coords.update(coords)
+        results[index] = xarray.DataArray(
+            values[..., j].astype(template.dtype),
+            dims=point.dims,
+            coords=index_coords,
+            attrs=template.attrs,
+            name=index,
+        )
+    return results
+
 
 def _extract_nao_ts(x):
-    iceland_ts = _extract_ts(x, -25, -16, 63, 70)
-    azores_ts = _extract_ts(x, -28, -20, 36, 40)
-    nao = azores_ts - iceland_ts
-    return nao
+    return _extract_index_ts(x, "nao")
 
 
-# NINO indices require SST
 def _extract_nino1_ts(x):
-    # Nino 1 - SST anomalies
-    nino1 = _extract_ts(x, 270, 280, -10, -5)
-    return nino1
+    return _extract_index_ts(x, "nino1")
 
 
 def _extract_nino2_ts(x):
-    # Nino 2 - SST anomalies
-    nino2 = _extract_ts(x, 270, 280, -5, 0)
-    return nino2
+    return _extract_index_ts(x, "nino2")
 
 
 def _extract_nino12_ts(x):
-    # Nino 1.2 - SST anomalies
-    nino12 = _extract_ts(x, 270, 280, -10, 0)
-    return nino12
+    return _extract_index_ts(x, "nino12")
 
 
 def _extract_nino3_ts(x):
-    # Nino 3 - SST anomalies
-    nino3 = _extract_ts(x, 210, 270, -5, 5)
-    return nino3
+    return _extract_index_ts(x, "nino3")
 
 
 def _extract_nino34_ts(x):
-    # Nino 3.4 - SST anomalies
-    nino34 = _extract_ts(x, 190, 240, -5, 5)
-    return nino34
+    return _extract_index_ts(x, "nino34")
 
 
 def _extract_nino4_ts(x):
-    # Nino 4 - SST anomalies
-    nino4 = _extract_ts(x, 160, 210, -5, 5)
-    return nino4
+    return _extract_index_ts(x, "nino4")
 
 
 def _extract_iod_ts(x):
-    # Dipole Mode Index [DMI - https://psl.noaa.gov/gcos_wgsp/Timeseries/DMI/]
-    # SST
-    iod_west = _extract_ts(x, 50, 70, -10, 10)
-    iod_east = _extract_ts(x, 90, 110, -10, 0)
-    return iod_west - iod_east
+    return _extract_index_ts(x, "iod")
 
 
 def _extract_pdv_ts(x):
-    # Pacific Decadal Variability [PDV]
-    # SST
-    tropical = _extract_ts(x, 200, 250, -10, 6)
-    northern = _extract_ts(x, 180, 215, 30, 45)
-    return tropical - northern
+    return _extract_index_ts(x, "pdv")
 
 
 def _extract_ipo_ts(x):
-    # Interdecadal Pacific Oscillation
-    # SST
-    northern = _extract_ts(x, 140, 215, 25, 45)
-    middle = _extract_ts(x, 170, 270, -10, 10)
-    southern = _extract_ts(x, 150, 200, -50, -15)
-    ipo = middle - 0.5 * (northern + southern)
-    return ipo
+    return _extract_index_ts(x, "ipo")
 
 
 def _extract_ea_ts(x):
-    # East Atlantic
-    # MSLP
-    def _matlab_mod(a, b):
-        return a - b * np.floor(a / b)
-
-    xcoord = _matlab_mod(-27.5, 360.0)
-    ycoord = 52.5
-    xr = xarray.DataArray.from_iris(x)
-    ea = xr.sel(lat=ycoord, lon=xcoord, method="nearest")
-    ea = ea.to_iris()
-    return ea
+    return _extract_index_ts(x, "ea")
 
 
 def _extract_amv_ts(x):
-    # Atlantic Multidecadal Variability
-    # T
-    north_atlantic_ts = _extract_ts(x, -80, 0, 0, 60)
-    global_ts = _extract_ts(x, -180, 180, -60, 60)
-    amv = north_atlantic_ts - global_ts
-    return amv
+    return _extract_index_ts(x, "amv")
 
 
 def _extract_european_precip_ts(x):
-    # Northern Europe precipitation
-    # P
-    european_precip_ts = _extract_ts(x, -10, 25, 55, 70)
-    return european_precip_ts
+    return _extract_index_ts(x, "european_precip")
 
 
 def _extract_uk_precip_ts(x):
-    # UK precipitation
-    # P
-    uk_precip_ts = _extract_ts(x, -8, 2, 50, 59)
-    return uk_precip_ts
+    return _extract_index_ts(x, "uk_precip")
 
 
 def _extract_uk_temp_ts(x):
-    # UK temperature
-    # T
-    uk_temp_ts = _extract_ts(x, -8, 2, 50, 59)
-    return uk_temp_ts
+    return _extract_index_ts(x, "uk_temp")
 
 
 def _extract_sahel_precip_ts(x):
-    # Sahelian preciptiation
-    # P
-    sahel_precip_ts = _extract_ts(x, -16, 36, 10, 20)
-    return sahel_precip_ts
+    return _extract_index_ts(x, "sahel_precip")
 
 
 def _extract_uk_precip_field(x):